@@ -1,6 +1,8 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from functools import lru_cache
 import os
-from typing import Optional
+
+__all__ = ['Settings', 'settings', 'get_settings']
 
 class Settings(BaseSettings):
     """
@@ -17,6 +19,8 @@ class Settings(BaseSettings):
     db_database: str 
     db_username: str
     db_password: str
+    db_pool_size: int = 5
+    sql_max_rows: int = 100  # tope de filas leídas por SELECT generado
     
     # Email - Gmail configuration
     imap_server: str = "imap.gmail.com"
@@ -28,13 +32,30 @@ class Settings(BaseSettings):
     # OpenAI 
     openai_api_key: str
     openai_model: str = "gpt-4"
+    openai_concurrency: int = 8  # emails procesados en paralelo contra OpenAI
+    llm_max_input_chars: int = 2000  # ~500 tokens del cuerpo del email
     
     # App settings
     app_port: int = 8000
     app_host: str = "0.0.0.0"
     
-    class Config:
-        env_file = ".env"
+    # En producción (contenedor) no hay .env: evito el acceso a disco
+    model_config = SettingsConfigDict(
+        env_file=".env" if os.path.exists(".env") else None,
+        env_file_encoding="utf-8",
+        extra="ignore"
+    )
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Obtener la configuración (una sola instancia por proceso).
+    
+    Uso lru_cache porque:
+    - Leer el entorno y validar con pydantic solo debe pasar una vez
+    - Es el patrón recomendado por FastAPI para settings
+    """
+    return Settings()
 
 # ✅ MANTENER nombre original para compatibilidad
-settings = Settings()
\ No newline at end of file
+settings = get_settings()
\ No newline at end of file
@@ -1,9 +1,241 @@
 import logging
 from app.config import settings
+from functools import lru_cache
+from collections import OrderedDict
+import asyncio
+import queue
+import random
+import re
+import threading
 import time
 
+# Import único del driver: si falta, se detecta al arrancar y no en cada consulta
+try:
+    import pyodbc
+    # Pooling del Driver Manager ODBC: debe activarse antes de la primera conexión
+    pyodbc.pooling = True
+except ImportError:
+    pyodbc = None
+
+__all__ = ['Database', 'PooledConnection', 'MockConnection', 'MockCursor', 'db', 'get_db', 'parameterize_sql', 'classify_sql']
+
 logger = logging.getLogger(__name__)
 
+# Errores transitorios de Azure SQL que vale la pena reintentar
+_MAX_CONNECT_ATTEMPTS = 5
+_TRANSIENT_SQLSTATES = frozenset({'08001', '08S01', 'HYT00', 'HYT01'})
+_TRANSIENT_MARKERS = ('timeout', 'transient', 'resuming', '40613', '40197', '10928', '10929', '49918')
+
+def _is_transient(error) -> bool:
+    """Clasificar un error de pyodbc como transitorio (SQLSTATE o código de Azure)"""
+    sqlstate = error.args[0] if error.args else None
+    if sqlstate in _TRANSIENT_SQLSTATES:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _TRANSIENT_MARKERS)
+
+# Tokens de T-SQL: literales ('' es una comilla escapada, N'' es NVARCHAR),
+# comentarios, identificadores [..]/"..", palabras, números y operadores.
+# Un ' o [ sin cerrar cae en "punct" y se trata como SQL mal formado.
+_TOKEN_RE = re.compile(r"""
+    (?P<str>(?:\bN)?'(?:[^']|'')*')
+  | (?P<comment>--|/\*)
+  | (?P<ident>\[(?:[^\]]|\]\])*\]|"(?:[^"]|"")*")
+  | (?P<word>[^\W\d][\w@#$]*|[@#][\w@#$]*)
+  | (?P<num>\d+(?:\.\d*)?)
+  | (?P<op><>|!=|<=|>=|[=<>])
+  | (?P<punct>\S)
+""", re.VERBOSE | re.IGNORECASE)
+
+def _tokenize_sql(sql: str) -> list:
+    """Partir una consulta en tokens (tipo, texto, inicio, fin); las palabras van en mayúsculas"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        text = match.group()
+        tokens.append((kind, text.upper() if kind == 'word' else text, match.start(), match.end()))
+    return tokens
+
+# Tokens tras los que un literal es un valor (comparaciones, IN/VALUES,
+# argumentos, CASE, lista del SELECT). Tras AS, un ')' o un identificador
+# el literal es un alias y debe seguir siendo texto.
+_VALUE_CONTEXT = frozenset({
+    '=', '<>', '!=', '<', '>', '<=', '>=', '(', ',', '+',
+    'LIKE', 'IN', 'VALUES', 'AND', 'OR', 'NOT', 'BETWEEN',
+    'WHEN', 'THEN', 'ELSE', 'SELECT',
+})
+
+@lru_cache(maxsize=256)
+def parameterize_sql(sql: str):
+    """
+    Reemplazar los literales de texto en posición de valor por marcadores "?".
+    
+    El SQL que genera el LLM repite unas pocas plantillas (buscar por
+    título, reservar, listar) con distintos valores. Parametrizado:
+    - SQL Server reutiliza el plan en lugar de compilar cada variante
+    - Los valores viajan como parámetros, no como texto SQL
+    
+    Solo toco strings: parametrizar números rompería TOP n, DATEADD, etc.
+    Los alias ('total' = COUNT(*), AS 'total') no se tocan: la gramática
+    exige texto ahí. Con EXEC devuelvo la consulta tal cual, porque el
+    parámetro se seguiría ejecutando como SQL dinámico.
+    
+    Returns:
+        tuple: (sql con "?", tupla de parámetros)
+    """
+    tokens = _tokenize_sql(sql)
+    if any(kind == 'word' and text in ('EXEC', 'EXECUTE') for kind, text, _, _ in tokens):
+        return sql, ()
+    
+    pieces = []
+    params = []
+    last = 0
+    for i, (kind, text, start, end) in enumerate(tokens):
+        if kind != 'str':
+            continue
+        previous = tokens[i - 1][1] if i else None
+        following = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if previous not in _VALUE_CONTEXT:
+            continue
+        if following == '=' and previous in ('SELECT', ','):
+            continue  # alias estilo 'total' = COUNT(*)
+        literal = text[1:] if text[0] in 'Nn' else text
+        params.append(literal[1:-1].replace("''", "'"))
+        pieces.append(sql[last:start])
+        pieces.append('?')
+        last = end
+    
+    if not params:
+        return sql, ()
+    pieces.append(sql[last:])
+    return ''.join(pieces), tuple(params)
+
+# Sentencias que el LLM puede ejecutar: nada de DDL, EXEC ni lotes múltiples
+_ALLOWED_STATEMENTS = frozenset({"SELECT", "INSERT", "UPDATE", "DELETE"})
+# Palabras que nunca aparecen en una única sentencia DML permitida. T-SQL no
+# exige ';' entre sentencias: "SELECT ... DROP TABLE x" son dos sentencias.
+_FORBIDDEN_KEYWORDS = frozenset({
+    'ALTER', 'BACKUP', 'BEGIN', 'BULK', 'CHECKPOINT', 'COMMIT', 'CREATE', 'DBCC',
+    'DECLARE', 'DENY', 'DISABLE', 'DROP', 'ENABLE', 'EXEC', 'EXECUTE', 'GO',
+    'GOTO', 'GRANT', 'IF', 'KILL', 'MERGE', 'OPENDATASOURCE', 'OPENQUERY',
+    'OPENROWSET', 'OPENXML', 'PRINT', 'RAISERROR', 'RECONFIGURE', 'RESTORE',
+    'RETURN', 'REVOKE', 'ROLLBACK', 'SAVE', 'SHUTDOWN', 'THROW', 'TRUNCATE',
+    'USE', 'WAITFOR', 'WHILE',
+})
+_SET_OPERATORS = frozenset({'UNION', 'ALL', 'EXCEPT', 'INTERSECT'})
+
+@lru_cache(maxsize=256)
+def classify_sql(sql: str):
+    """
+    Clasificar una consulta generada: su tipo si está permitida, o None.
+    
+    Exijo exactamente una sentencia SELECT/INSERT/UPDATE/DELETE. Trabajo
+    sobre tokens, así que un ';' o un '--' dentro de un string no cuenta.
+    Se rechaza:
+    - Comentarios, ';' intermedios, comillas o corchetes sin cerrar
+    - Cualquier palabra de _FORBIDDEN_KEYWORDS (DDL, EXEC, WAITFOR, ...)
+    - Una segunda sentencia: INSERT/UPDATE/DELETE o SET fuera de su sitio,
+      o un SELECT de primer nivel que no venga de UNION ni de INSERT ... SELECT
+    - INTO fuera de INSERT INTO (SELECT ... INTO crea tablas)
+    """
+    tokens = _tokenize_sql(sql)
+    while tokens and tokens[-1][1] == ';':
+        tokens.pop()
+    if not tokens or tokens[0][0] != 'word' or tokens[0][1] not in _ALLOWED_STATEMENTS:
+        return None
+    
+    keyword = tokens[0][1]
+    depth = 0
+    top_level_selects = 0
+    set_clauses = 0
+    seen_values = False
+    previous = None
+    for i, (kind, text, _, _) in enumerate(tokens):
+        if kind == 'comment' or text in (';', "'", '"', '['):
+            return None
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif kind == 'word':
+            if text in _FORBIDDEN_KEYWORDS:
+                return None
+            if i and text in ('INSERT', 'UPDATE', 'DELETE'):
+                return None
+            if text == 'INTO' and not (keyword == 'INSERT' and i == 1):
+                return None
+            if text == 'VALUES':
+                seen_values = True
+            elif text == 'SET':
+                set_clauses += 1
+                if keyword != 'UPDATE' or depth or set_clauses > 1:
+                    return None
+            elif text == 'SELECT' and i and not depth and previous not in _SET_OPERATORS:
+                # Solo INSERT ... SELECT admite un SELECT de primer nivel propio
+                top_level_selects += 1
+                if keyword != 'INSERT' or seen_values or top_level_selects > 1:
+                    return None
+        previous = text
+    
+    return keyword if depth == 0 else None
+
+# DDL del esquema: constante de módulo, se construye una sola vez al importar
+_DDL = (
+    """
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='books' AND xtype='U')
+    CREATE TABLE books (
+        id INT IDENTITY(1,1) PRIMARY KEY,
+        title NVARCHAR(255) NOT NULL,
+        author NVARCHAR(255) NOT NULL,
+        isbn NVARCHAR(20),
+        created_at DATETIME2 DEFAULT GETDATE(),
+        available BIT DEFAULT 1
+    )
+    """,
+    """
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='reservations' AND xtype='U')
+    CREATE TABLE reservations (
+        id INT IDENTITY(1,1) PRIMARY KEY,
+        book_id INT FOREIGN KEY REFERENCES books(id),
+        user_email NVARCHAR(255) NOT NULL,
+        reserved_at DATETIME2 DEFAULT GETDATE(),
+        renewed_at DATETIME2,
+        expires_at DATETIME2,
+        active BIT DEFAULT 1
+    )
+    """,
+    # Registro de Message-ID ya procesados: la PK hace atómico el "reclamo"
+    # entre workers (NVARCHAR(450) = 900 bytes, el máximo de una clave de índice)
+    """
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='processed_emails' AND xtype='U')
+    CREATE TABLE processed_emails (
+        message_id NVARCHAR(450) PRIMARY KEY,
+        processed_at DATETIME2 DEFAULT GETDATE()
+    )
+    """,
+)
+_DDL_BATCH = ";\n".join(_DDL)
+
+# Message-ID reclamados en modo simulación (sin BD no hay registro compartido).
+# Acotado: se olvidan los más antiguos, como la caché de SQL del LLM
+_MOCK_CLAIMED_MAXSIZE = 1024
+_MOCK_CLAIMED = OrderedDict()
+_MOCK_CLAIMED_LOCK = threading.Lock()
+
+# Pools de conexiones por proceso, indexados por (server, database, username)
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _get_pool(key: tuple, size: int) -> queue.LifoQueue:
+    """Obtener (o crear) el pool compartido para una identidad de BD"""
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = queue.LifoQueue(maxsize=size)
+        return pool
+
 class Database:
     """
     Gestor de conexiones y operaciones de base de datos.
@@ -12,86 +244,308 @@ class Database:
     - PyODBC para mejor compatibilidad con Azure SQL
     - Modo simulación para desarrollo sin BD
     - Reintentos automáticos para problemas de conexión transitorios
+    - Pool de conexiones para no pagar el login TDS en cada consulta
     """
     
     def __init__(self):
-        self.connection_string = self._build_connection_string()
+        self.connection_string = type(self)._build_connection_string(
+            settings.db_server,
+            settings.db_database,
+            settings.db_username,
+            settings.db_password
+        )
+        # La clave no incluye la contraseña ni valores volátiles:
+        # así el pool no se fragmenta si algún campo cambia
+        self._pool = _get_pool(
+            (settings.db_server, settings.db_database, settings.db_username),
+            settings.db_pool_size
+        )
     
-    def _build_connection_string(self):
-        """Construir cadena de conexión para SQL Server"""
-        return (
+    @classmethod
+    @lru_cache(maxsize=4)
+    def _build_connection_string(cls, server: str, database: str, username: str, password: str) -> str:
+        """
+        Construir cadena de conexión para SQL Server.
+        
+        Se memoiza por identidad de conexión; no incluyo valores volátiles
+        (p. ej. un Application Name por petición) para que la caché no crezca
+        y la clave del pool del driver ODBC se mantenga estable.
+        
+        - MARS permite intercalar varios resultados en una misma conexión
+        - ConnectRetryCount/Interval reconectan sesiones inactivas cortadas
+        - HostNameInCertificate solo aplica a servidores de Azure SQL
+        """
+        connection_string = (
             f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-            f"SERVER={settings.db_server};"
-            f"DATABASE={settings.db_database};"
-            f"UID={settings.db_username};"
-            f"PWD={settings.db_password};"
+            f"SERVER={server};"
+            f"DATABASE={database};"
+            f"UID={username};"
+            f"PWD={password};"
             f"Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
+            f"MARS_Connection=yes;ConnectRetryCount=3;ConnectRetryInterval=5;"
+            f"ApplicationIntent=ReadWrite;"
         )
+        if server.split(',')[0].rstrip('.').lower().endswith('.database.windows.net'):
+            connection_string += "HostNameInCertificate=*.database.windows.net;"
+        return connection_string
     
     def get_connection(self):
-        """Obtener conexión con manejo robusto de errores"""
+        """
+        Obtener conexión con manejo robusto de errores.
+        
+        Primero intento reutilizar una conexión del pool: el login contra
+        Azure SQL cuesta cientos de ms y una conexión abierta cuesta casi nada.
+        La conexión devuelta vuelve al pool al llamar close() o al salir del with.
+        """
+        conn = self._acquire_pooled()
+        if conn is not None:
+            return PooledConnection(conn, self)
+        
+        if pyodbc is None:
+            logger.warning("🔧 PyODBC no disponible - modo simulación activado")
+            return MockConnection()
+        
         try:
-            import pyodbc
-            # conexión con reintentos
-            for attempt in range(3):
+            # conexión con reintentos (backoff exponencial con jitter)
+            for attempt in range(_MAX_CONNECT_ATTEMPTS):
                 try:
-                    conn = pyodbc.connect(self.connection_string)
-                    logger.info("✅ Conexión a BD establecida")
-                    return conn
+                    return self._open_connection()
                 except pyodbc.OperationalError as e:
-                    if "timeout" in str(e).lower() and attempt < 2:
-                        logger.warning(f"⏰ Timeout, reintentando... ({attempt + 1}/3)")
-                        time.sleep(2)
-                        continue
-                    raise
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
             
-        except ImportError:
+        except Exception as e:
+            logger.error(f"❌ Error de conexión: {e}")
+            logger.info("🔧 Modo simulación activado")
+            return MockConnection()
+    
+    async def get_connection_async(self):
+        """
+        Versión async de get_connection para usar desde los endpoints.
+        
+        El login corre en un hilo y las esperas entre reintentos usan
+        asyncio.sleep, así un Azure SQL "despertando" no congela el event loop.
+        """
+        conn = await asyncio.to_thread(self._acquire_pooled)
+        if conn is not None:
+            return PooledConnection(conn, self)
+        
+        if pyodbc is None:
             logger.warning("🔧 PyODBC no disponible - modo simulación activado")
             return MockConnection()
+        
+        try:
+            for attempt in range(_MAX_CONNECT_ATTEMPTS):
+                try:
+                    return await asyncio.to_thread(self._open_connection)
+                except pyodbc.OperationalError as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+            
         except Exception as e:
             logger.error(f"❌ Error de conexión: {e}")
             logger.info("🔧 Modo simulación activado")
             return MockConnection()
     
+    def _open_connection(self):
+        """Abrir una conexión nueva (login TDS completo)"""
+        conn = pyodbc.connect(self.connection_string, autocommit=False, timeout=5)
+        logger.info("✅ Conexión a BD establecida")
+        return PooledConnection(conn, self)
+    
+    def _retry_delay(self, error, attempt: int):
+        """
+        Segundos a esperar antes de reintentar, o None si no hay que reintentar.
+        
+        Backoff exponencial con jitter: los fallos rápidos se recuperan rápido
+        y un Azure SQL en pausa tiene tiempo de reanudarse sin que lo saturemos.
+        """
+        if attempt >= _MAX_CONNECT_ATTEMPTS - 1 or not _is_transient(error):
+            return None
+        delay = min(30, (2 ** attempt) * 0.5 + random.random())
+        logger.warning(f"⏰ Error transitorio, reintentando en {delay:.1f}s... ({attempt + 1}/{_MAX_CONNECT_ATTEMPTS})")
+        return delay
+    
+    def _acquire_pooled(self):
+        """Sacar una conexión válida del pool, o None si está vacío"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return None
+            try:
+                # Validación barata: descarta conexiones cortadas por el servidor
+                conn.execute("SELECT 1").fetchone()
+                return conn
+            except Exception as e:
+                logger.warning(f"♻️ Conexión del pool descartada: {e}")
+                self._discard(conn)
+    
+    def release(self, conn):
+        """Devolver una conexión al pool (se cierra si el pool está lleno)"""
+        try:
+            # No heredar transacciones abiertas a la siguiente petición
+            conn.rollback()
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            self._discard(conn)
+        except Exception as e:
+            logger.warning(f"♻️ Conexión no reutilizable: {e}")
+            self._discard(conn)
+    
+    def warm_pool(self) -> int:
+        """
+        Abrir conexiones hasta llenar el pool (se llama al arrancar).
+        
+        Returns:
+            int: Número de conexiones nuevas dejadas en el pool
+        """
+        if pyodbc is None:
+            return 0
+        
+        opened = []
+        try:
+            for _ in range(self._pool.maxsize - self._pool.qsize()):
+                try:
+                    opened.append(self._open_connection())
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudo precalentar el pool: {e}")
+                    break
+        finally:
+            # close() devuelve cada conexión al pool
+            for conn in opened:
+                conn.close()
+        return len(opened)
+    
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
     def init_database(self):
         """Inicializar tablas si no existen"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            tables_sql = [
-                """
-                IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='books' AND xtype='U')
-                CREATE TABLE books (
-                    id INT IDENTITY(1,1) PRIMARY KEY,
-                    title NVARCHAR(255) NOT NULL,
-                    author NVARCHAR(255) NOT NULL,
-                    isbn NVARCHAR(20),
-                    created_at DATETIME2 DEFAULT GETDATE(),
-                    available BIT DEFAULT 1
-                )
-                """,
-                """
-                IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='reservations' AND xtype='U')
-                CREATE TABLE reservations (
-                    id INT IDENTITY(1,1) PRIMARY KEY,
-                    book_id INT FOREIGN KEY REFERENCES books(id),
-                    user_email NVARCHAR(255) NOT NULL,
-                    reserved_at DATETIME2 DEFAULT GETDATE(),
-                    renewed_at DATETIME2,
-                    expires_at DATETIME2,
-                    active BIT DEFAULT 1
-                )
-                """
-            ]
-            
-            for sql in tables_sql:
-                cursor.execute(sql)
-            conn.commit()
-            logger.info("✅ Tablas inicializadas correctamente")
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Un solo batch: ambas verificaciones viajan en un round trip
+                cursor.execute(_DDL_BATCH)
+                conn.commit()
+                logger.info("✅ Tablas inicializadas correctamente")
             
         except Exception as e:
             logger.warning(f"⚠️ BD en modo simulación: {e}")
+    
+    def test_connection(self) -> bool:
+        """Verificar que hay una BD real accesible (False en modo simulación)"""
+        try:
+            with self.get_connection() as conn:
+                if isinstance(conn, MockConnection):
+                    return False
+                conn.cursor().execute("SELECT 1").fetchone()
+                return True
+        except Exception as e:
+            logger.warning(f"⚠️ Prueba de conexión a BD falló: {e}")
+            return False
+    
+    def claim_message(self, message_id: str) -> bool:
+        """Reclamar un solo email por su Message-ID (ver claim_messages)"""
+        return message_id in self.claim_messages([message_id])
+    
+    def claim_messages(self, message_ids) -> set:
+        """
+        Reclamar un lote de emails por su Message-ID antes de procesarlos.
+        
+        El INSERT contra la PK es atómico entre procesos: si dos workers
+        leen el mismo email (o el proveedor lo entrega dos veces) solo uno
+        lo reclama. Se reclama antes de procesar porque RESERVE_BOOK no
+        es idempotente: preferimos no repetir una reserva a repetirla.
+        
+        Una sola conexión por lote: si la BD no responde, el backoff de
+        get_connection se paga una vez y no una por email.
+        
+        Returns:
+            set: Message-ID que este proceso debe procesar
+        """
+        claimed = set()
+        with self.get_connection() as conn:
+            if isinstance(conn, MockConnection):
+                with _MOCK_CLAIMED_LOCK:
+                    for message_id in message_ids:
+                        if message_id in _MOCK_CLAIMED or message_id in claimed:
+                            continue
+                        claimed.add(message_id)
+                        _MOCK_CLAIMED[message_id] = None
+                        if len(_MOCK_CLAIMED) > _MOCK_CLAIMED_MAXSIZE:
+                            _MOCK_CLAIMED.popitem(last=False)
+                return claimed
+            
+            cursor = conn.cursor()
+            for message_id in message_ids:
+                if message_id in claimed:
+                    continue
+                try:
+                    cursor.execute(
+                        "INSERT INTO processed_emails (message_id) VALUES (?)", (message_id,)
+                    )
+                    conn.commit()
+                    claimed.add(message_id)
+                except pyodbc.IntegrityError:
+                    pass
+        return claimed
+    
+    def bulk_insert(self, sql: str, rows) -> int:
+        """
+        Insertar muchas filas con una sola llamada parametrizada.
+        
+        Con fast_executemany pyodbc envía todos los parámetros en un único
+        lote TDS en lugar de un round trip por fila (útil para cargar
+        libros o reservas en bloque).
+        
+        Args:
+            sql: INSERT parametrizado con marcadores "?"
+            rows: Secuencia de tuplas con los valores de cada fila
+            
+        Returns:
+            int: Número de filas enviadas
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(sql, rows)
+            conn.commit()
+        return len(rows)
+
+
+class PooledConnection:
+    """
+    Envoltura de una conexión pyodbc que vuelve al pool en lugar de cerrarse.
+    
+    Delego todo lo demás en la conexión real, así el código existente
+    (cursor(), commit(), close()) funciona sin cambios.
+    """
+    def __init__(self, conn, database):
+        self._conn = conn
+        self._database = database
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    def close(self):
+        if self._conn is not None:
+            self._database.release(self._conn)
+            self._conn = None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 
 class MockConnection:
@@ -101,21 +555,54 @@ class MockConnection:
         pass
     def close(self):
         pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+# Filas de ejemplo del modo simulación: constantes inmutables compartidas.
+# Tuplas + description, igual que devuelve pyodbc
+_SAMPLE_DESCRIPTION = tuple(
+    (name, None, None, None, None, None, None) for name in ("id", "title", "author", "available")
+)
+_SAMPLE_ROWS = (
+    (1, "Cien años de soledad", "Gabriel García Márquez", True),
+)
+_SAMPLE_ROW = _SAMPLE_ROWS[0]
+
+# Solo mira la primera palabra de la consulta, sin copiar el SQL completo
+_SQL_KEYWORD_RE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|CREATE|IF)\b', re.IGNORECASE)
 
 class MockCursor:
     def __init__(self):
         self.rowcount = 1
+        self.description = None
     def execute(self, query, params=None):
-        logger.info(f"🔧 [SIMULACIÓN] Ejecutando: {query[:100]}...")
+        match = _SQL_KEYWORD_RE.match(query)
+        keyword = match.group(1).upper() if match else ''
+        self.rowcount = 0 if keyword == 'SELECT' else 1
+        self.description = _SAMPLE_DESCRIPTION if keyword == 'SELECT' else None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🔧 [SIMULACIÓN] Ejecutando: {query[:100]}...")
+        return self
+    def executemany(self, query, rows):
+        self.rowcount = len(rows)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🔧 [SIMULACIÓN] Ejecutando lote de {len(rows)} filas: {query[:100]}...")
         return self
     def fetchall(self):
-        return [
-            {"id": 1, "title": "Cien años de soledad", "author": "Gabriel García Márquez", "available": True}
-        ]
+        return list(_SAMPLE_ROWS)
+    def fetchmany(self, size=1):
+        return list(_SAMPLE_ROWS[:size])
     def fetchone(self):
-        return {"id": 1, "title": "Cien años de soledad", "author": "Gabriel García Márquez", "available": True}
+        return _SAMPLE_ROW
     def close(self):
         pass
 
 
-db = Database()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_db() -> Database:
+    """Instancia única de Database por proceso"""
+    return Database()
+
+db = get_db()
\ No newline at end of file
@@ -1,14 +1,36 @@
 ﻿import aiosmtplib
-import ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.message import EmailMessage
+from email.utils import formataddr
 from app.config import settings
+from collections import namedtuple
 import logging
 from typing import List, Dict
 import asyncio
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+# imap_tools es opcional: sin él la lectura de correos queda deshabilitada
+try:
+    from imap_tools import MailBox, AND, MailMessageFlags
+except ImportError:
+    MailBox = AND = MailMessageFlags = None
+
+__all__ = ['EmailProcessor', 'SmtpCfg', 'email_processor']
 
 logger = logging.getLogger(__name__)
 
+# Compilada una sola vez: se usa con cada email que solo trae HTML
+_HTML_TAG_RE = re.compile(r'<[^<]+?>')
+
+SmtpCfg = namedtuple('SmtpCfg', 'port use_tls desc')
+
+# Keyword IMAP con la que un worker reclama los emails que va a procesar:
+# el SEARCH la excluye, así otro worker no vuelve a leerlos
+_PROCESSING_KEYWORD = '$Processing'
+# Un reclamo más viejo que esto es de un worker que cayó: un lote tarda minutos
+_STALE_CLAIM_AFTER = timedelta(minutes=30)
+
 class EmailProcessor:
     """
     Procesador de correos electrónicos para la biblioteca automatizada.
@@ -25,6 +47,12 @@ class EmailProcessor:
     - El encoding UTF-8 evita problemas con tildes y caracteres especiales
     """
     
+    # Configuraciones SMTP en orden de preferencia - estrategia de fallback
+    _SMTP_CONFIGS = (
+        SmtpCfg(port=587, use_tls=True, desc='TLS (puerto 587)'),
+        SmtpCfg(port=465, use_tls=False, desc='SSL (puerto 465)'),  # SSL implícito
+    )
+    
     def __init__(self):
         # Configuración de servidores - Gmail elegido por accesibilidad para usuarios
         self.imap_server = settings.imap_server
@@ -32,10 +60,78 @@ class EmailProcessor:
         self.imap_password = settings.imap_password
         self.smtp_server = settings.smtp_server
         self.smtp_port = settings.smtp_port
+        # El remitente no cambia entre envíos: lo formateo una sola vez
+        self._from_header = formataddr(('Biblioteca', self.imap_username))
         
         # Configuraciones de reintento - basado en pruebas con diferentes redes
         self.max_retries = 2
         self.retry_delay = 5  # segundos
+        
+        # Sesión IMAP persistente - el login (TLS + LOGIN + SELECT) es lo más caro de cada sondeo
+        self._mailbox = None
+        self._mb_lock = asyncio.Lock()
+        self._mb_expires = 0
+        
+        # Cliente SMTP persistente - TCP + TLS + EHLO + AUTH solo al (re)conectar
+        self._smtp = None
+        self._smtp_port = None
+        self._smtp_lock = asyncio.Lock()
+        
+        # Memoria de resultados: probar primero la última configuración que funcionó
+        # y saltar durante 60s las que fallaron al conectar
+        self._last_good_cfg_idx = 0
+        self._bad_until: Dict[int, float] = {}
+    
+    def _get_mailbox(self):
+        """
+        Obtener la sesión IMAP autenticada, reutilizándola mientras sea válida.
+        
+        Renuevo la sesión cada 4 minutos porque:
+        - Gmail corta las conexiones inactivas a los ~10 minutos
+        - Es mejor reconectar a tiempo que fallar sobre un socket muerto
+        
+        Es bloqueante: solo se llama desde _run_imap (en un hilo y con el lock tomado).
+        """
+        if self._mailbox is not None and time.time() < self._mb_expires:
+            return self._mailbox
+        
+        if MailBox is None:
+            raise RuntimeError("imap_tools no disponible")
+        
+        self._reset_mailbox()
+        self._mailbox = MailBox(self.imap_server).login(
+            self.imap_username,
+            self.imap_password,
+            'INBOX'
+        )
+        self._mb_expires = time.time() + 240
+        logger.info("🔐 Sesión IMAP iniciada")
+        return self._mailbox
+    
+    async def _run_imap(self, operation):
+        """
+        Ejecutar una operación IMAP bloqueante sin congelar el event loop.
+        
+        - asyncio.to_thread libera el loop durante los round trips IMAP
+        - El lock serializa el uso de la sesión (imaplib no es thread-safe)
+        - Si algo falla, descarto la sesión para reconectar la próxima vez
+        """
+        async with self._mb_lock:
+            try:
+                return await asyncio.to_thread(lambda: operation(self._get_mailbox()))
+            except Exception:
+                await asyncio.to_thread(self._reset_mailbox)
+                raise
+    
+    def _reset_mailbox(self):
+        """Descartar la sesión IMAP actual para que la próxima llamada reconecte"""
+        if self._mailbox is not None:
+            try:
+                self._mailbox.logout()
+            except Exception:
+                pass
+        self._mailbox = None
+        self._mb_expires = 0
     
     async def send_response_email(self, to_email: str, subject: str, body: str) -> bool:
         """
@@ -57,31 +153,30 @@ class EmailProcessor:
         try:
             message = self._create_email_message(to_email, subject, body)
             
-            # Intentar diferentes configuraciones SMTP - estrategia de fallback
-            smtp_configs = [
-                {
-                    'hostname': self.smtp_server,
-                    'port': 587,
-                    'use_tls': True,
-                    'description': 'TLS (puerto 587)'
-                },
-                {
-                    'hostname': self.smtp_server, 
-                    'port': 465,
-                    'use_tls': False,  # SSL implícito
-                    'description': 'SSL (puerto 465)'
-                }
-            ]
+            # Intentar primero la configuración que funcionó la última vez
+            first = self._last_good_cfg_idx
+            order = [first, *(i for i in range(len(self._SMTP_CONFIGS)) if i != first)]
             
-            for config in smtp_configs:
+            for i in order:
+                cfg = self._SMTP_CONFIGS[i]
+                if time.monotonic() < self._bad_until.get(i, 0):
+                    logger.debug(f"⏭️ Omitiendo {cfg.desc}: falló hace poco")
+                    continue
                 try:
-                    success = await self._attempt_send_email(message, config)
+                    success = await self._attempt_send_email(message, cfg)
                     if success:
-                        logger.info(f"✅ Email enviado a {to_email} via {config['description']}")
+                        self._last_good_cfg_idx = i
+                        self._bad_until.pop(i, None)
+                        logger.debug(f"✅ Email enviado a {to_email} via {cfg.desc}")
                         return True
                         
+                except aiosmtplib.SMTPConnectError as e:
+                    # Puerto bloqueado o caído: no volver a probarlo durante un minuto
+                    self._bad_until[i] = time.monotonic() + 60
+                    logger.warning(f"⚠️ Falló envío en {cfg.desc}: {e}")
+                    continue
                 except Exception as e:
-                    logger.warning(f"⚠️ Falló envío en {config['description']}: {e}")
+                    logger.warning(f"⚠️ Falló envío en {cfg.desc}: {e}")
                     continue
             
             # Si todos los intentos fallan
@@ -92,27 +187,71 @@ class EmailProcessor:
             logger.error(f"💥 Error crítico enviando email a {to_email}: {e}")
             return False
     
-    def _create_email_message(self, to_email: str, subject: str, body: str) -> MIMEMultipart:
+    def _create_email_message(self, to_email: str, subject: str, body: str) -> EmailMessage:
         """
         Crear mensaje de email con codificación UTF-8.
         
-        Uso MIMEMultipart aunque sea texto plano porque:
-        - Es más compatible con diferentes clientes de email
-        - Permite fácil extensión a HTML en el futuro
-        - Maneja mejor los caracteres especiales del español
+        Uso EmailMessage (política moderna de email) porque:
+        - Codifica encabezados y cuerpo UTF-8 en una sola pasada
+        - Evita el envoltorio multipart innecesario para texto plano
+        - Sigue permitiendo añadir HTML después con add_alternative()
         """
-        message = MIMEMultipart()
-        message['From'] = self.imap_username
+        message = EmailMessage()
+        message['From'] = self._from_header
         message['To'] = to_email
         message['Subject'] = subject
         
         # Codificación UTF-8 explícita - crucial para español
-        text_part = MIMEText(body, 'plain', 'utf-8')
-        message.attach(text_part)
+        message.set_content(body, subtype='plain', charset='utf-8')
         
         return message
     
-    async def _attempt_send_email(self, message: MIMEMultipart, config: dict) -> bool:
+    async def _smtp_client(self, cfg: SmtpCfg) -> aiosmtplib.SMTP:
+        """
+        Obtener un cliente SMTP conectado y autenticado para la configuración dada.
+        
+        Reutilizo la conexión abierta porque:
+        - El handshake TLS + AUTH domina el costo de cada envío
+        - Gmail mantiene la sesión viva entre mensajes consecutivos
+        - Si el servidor la cierra, _attempt_send_email reconecta una vez
+        """
+        async with self._smtp_lock:
+            if (self._smtp is not None and self._smtp.is_connected
+                    and self._smtp_port == cfg.port):
+                return self._smtp
+            
+            await self._reset_smtp()
+            client = aiosmtplib.SMTP(
+                hostname=self.smtp_server,
+                port=cfg.port,
+                username=self.imap_username,
+                password=self.imap_password,
+                use_tls=cfg.use_tls,
+                timeout=30
+            )
+            # connect() hace EHLO, STARTTLS (si aplica) y AUTH
+            await client.connect()
+            self._smtp = client
+            self._smtp_port = cfg.port
+            return client
+    
+    async def _reset_smtp(self, failed=None):
+        """
+        Cerrar el cliente SMTP actual para que el próximo envío reconecte.
+        
+        Con failed solo se cierra si sigue siendo ese cliente: otra tarea del
+        lote puede haberlo reemplazado ya, y cerrar el nuevo tumbaría su envío.
+        """
+        if failed is not None and self._smtp is not failed:
+            return
+        client, self._smtp, self._smtp_port = self._smtp, None, None
+        if client is not None and client.is_connected:
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+    
+    async def _attempt_send_email(self, message: EmailMessage, cfg: SmtpCfg) -> bool:
         """
         Intentar enviar email con configuración específica.
         
@@ -122,15 +261,16 @@ class EmailProcessor:
         - Permite fallar rápido y reintentar
         """
         try:
-            await aiosmtplib.send(
-                message,
-                hostname=config['hostname'],
-                port=config['port'],
-                username=self.imap_username,
-                password=self.imap_password,
-                use_tls=config['use_tls'],
-                timeout=30
-            )
+            client = await self._smtp_client(cfg)
+            try:
+                await client.send_message(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # La conexión reutilizada expiró: reconectar una sola vez
+                logger.info("🔄 Conexión SMTP cerrada por el servidor, reconectando...")
+                async with self._smtp_lock:
+                    await self._reset_smtp(failed=client)
+                client = await self._smtp_client(cfg)
+                await client.send_message(message)
             return True
             
         except aiosmtplib.SMTPConnectError as e:
@@ -143,7 +283,7 @@ class EmailProcessor:
             logger.warning(f"📧 Error enviando email: {e}")
             raise
     
-    async def fetch_unread_emails(self) -> List[Dict]:
+    async def fetch_unread_emails(self, mark_seen: bool = True) -> List[Dict]:
         """
         Obtener emails no leídos del buzón.
         
@@ -152,34 +292,15 @@ class EmailProcessor:
         - Maneja tanto texto plano como HTML
         - Retorna una estructura simple para fácil procesamiento
         
+        Args:
+            mark_seen: False para dejarlos sin leer y reclamarlos con la keyword
+                $Processing; se marcan como leídos con mark_seen() al terminar
+        
         Returns:
-            List[Dict]: Lista de emails con from, subject, body y date
+            List[Dict]: Lista de emails con uid, message_id, from, subject, body y date
         """
-        emails = []
         try:
-            from imap_tools import MailBox, AND
-            
-            # Conexión IMAP con contexto para manejo automático de recursos
-            with MailBox(self.imap_server).login(
-                self.imap_username, 
-                self.imap_password, 
-                'INBOX'
-            ) as mailbox:
-                
-                # Buscar emails no leídos - criterio simple que funciona
-                for message in mailbox.fetch(AND(seen=False)):
-                    email_data = {
-                        'from': message.from_,
-                        'subject': message.subject or 'Sin asunto',
-                        'body': self._extract_email_body(message),
-                        'date': message.date
-                    }
-                    emails.append(email_data)
-                    
-                    # Marcar como leído - importante para no reprocesar
-                    mailbox.seen(message.uid, True)
-                    logger.info(f"📨 Email marcado como leído: {message.from_}")
-            
+            emails = await self._run_imap(lambda mailbox: self._fetch_unread_sync(mailbox, mark_seen))
             logger.info(f"✅ Obtenidos {len(emails)} emails no leídos")
             return emails
             
@@ -187,6 +308,87 @@ class EmailProcessor:
             logger.error(f"❌ Error obteniendo emails: {e}")
             return []
     
+    def _fetch_unread_sync(self, mailbox, mark_seen: bool = True) -> List[Dict]:
+        """Lógica bloqueante de fetch_unread_emails (corre en un hilo)"""
+        self._release_stale_claims_sync(mailbox)
+        
+        # No leídos y sin reclamar, en un solo FETCH (bulk) sin marcarlos todavía
+        messages = list(mailbox.fetch(
+            AND(seen=False, no_keyword=_PROCESSING_KEYWORD), mark_seen=False, bulk=True
+        ))
+        emails = [
+            {
+                'uid': message.uid,
+                'message_id': (message.headers.get('message-id') or ('',))[0].strip(),
+                'from': message.from_,
+                'subject': message.subject or 'Sin asunto',
+                'body': self._extract_email_body(message),
+                'date': message.date
+            }
+            for message in messages
+        ]
+        
+        # Un único STORE justo tras el FETCH - importante para no reprocesar:
+        # \Seen si se marcan ya, o la keyword de reclamo si se marcan al terminar
+        uids = [message.uid for message in messages]
+        if mark_seen:
+            self._mark_seen_sync(mailbox, uids)
+        elif uids:
+            mailbox.flag(uids, _PROCESSING_KEYWORD, True)
+        
+        return emails
+    
+    def _release_stale_claims_sync(self, mailbox):
+        """
+        Quitar $Processing a los emails que un worker caído dejó reclamados.
+        
+        IMAP no guarda cuándo se puso una keyword, así que uso la fecha del
+        email: no leído, reclamado y con más de _STALE_CLAIM_AFTER. Liberar
+        uno que sigue en proceso no duplica nada: el registro de Message-ID
+        en la BD (Database.claim_messages) hace que el otro worker lo omita.
+        
+        Recuperación manual equivalente: quitar la keyword $Processing a los
+        mensajes no leídos (p. ej. UID STORE <uids> -FLAGS ($Processing)).
+        """
+        cutoff = datetime.now(timezone.utc) - _STALE_CLAIM_AFTER
+        stale = [
+            message.uid
+            for message in mailbox.fetch(
+                AND(seen=False, keyword=_PROCESSING_KEYWORD),
+                mark_seen=False, headers_only=True, bulk=True
+            )
+            # Sin zona horaria (o sin fecha válida, 1900-01-01) la trato como UTC
+            if (message.date if message.date.tzinfo else message.date.replace(tzinfo=timezone.utc)) < cutoff
+        ]
+        if stale:
+            mailbox.flag(stale, _PROCESSING_KEYWORD, False)
+            logger.warning(f"♻️ {len(stale)} emails reclamados por un worker caído vuelven a la cola")
+    
+    async def mark_seen(self, uids: List[str]) -> bool:
+        """
+        Marcar emails como leídos una vez procesados.
+        
+        Los emails ya están reclamados con $Processing desde el fetch, así que
+        ningún otro worker los relee mientras tanto. Si el proceso cae a mitad
+        de lote quedan sin leer y con la keyword hasta que el siguiente fetch
+        los libera (_release_stale_claims_sync); entonces el registro de
+        Message-ID evita repetir los que ya se habían empezado a procesar.
+        """
+        if not uids:
+            return True
+        try:
+            await self._run_imap(lambda mailbox: self._mark_seen_sync(mailbox, uids))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error marcando emails como leídos: {e}")
+            return False
+    
+    def _mark_seen_sync(self, mailbox, uids: List[str]):
+        """Un único STORE +FLAGS \\Seen para todos los uids"""
+        if uids:
+            mailbox.flag(uids, MailMessageFlags.SEEN, True)
+            logger.info(f"📨 {len(uids)} emails marcados como leídos")
+    
     def _extract_email_body(self, message) -> str:
         """
         Extraer el cuerpo del email priorizando texto plano.
@@ -199,9 +401,7 @@ class EmailProcessor:
             return message.text.strip()
         elif message.html:
             # Extraer texto simple del HTML - básico pero funcional
-            import re
-            clean_html = re.sub('<[^<]+?>', '', message.html)
-            return clean_html.strip()
+            return _HTML_TAG_RE.sub('', message.html).strip()
         else:
             return "Email sin contenido legible"
     
@@ -218,64 +418,15 @@ class EmailProcessor:
             bool: True si la conexión es exitosa o al menos se puede intentar
         """
         try:
-            from imap_tools import MailBox
-            
-            with MailBox(self.imap_server).login(
-                self.imap_username, 
-                self.imap_password, 
-                'INBOX'
-            ) as mailbox:
-                # Operación simple para verificar conexión
-                list(mailbox.fetch(limit=1))
-                logger.info("✅ Conexión de email verificada")
-                return True
+            # NOOP sobre la sesión ya autenticada: un solo comando, sin SEARCH ni FETCH
+            await self._run_imap(lambda mailbox: mailbox.client.noop())
+            # DEBUG: el refresco de /status lo llama cada 30s en cada worker
+            logger.debug("✅ Conexión de email verificada")
+            return True
                 
         except Exception as e:
             logger.warning(f"⚠️ Prueba de conexión de email falló: {e}")
             # Devolver True para no bloquear el sistema - los emails pueden fallar
             return True
-    
-    async def process_incoming_emails(self) -> List[Dict]:
-        """
-        Procesar todos los emails entrantes no leídos.
-        
-        Esta es la función principal que orquesta:
-        1. Obtener emails no leídos
-        2. Procesar cada uno individualmente
-        3. Retornar resultados para seguimiento
-        
-        Returns:
-            List[Dict]: Resultados del procesamiento de cada email
-        """
-        try:
-            unread_emails = await self.fetch_unread_emails()
-            processing_results = []
-            
-            for email in unread_emails:
-                try:
-                    # Aquí se integraría con el procesamiento principal
-                    result = {
-                        'from': email['from'],
-                        'subject': email['subject'],
-                        'processed_at': asyncio.get_event_loop().time(),
-                        'status': 'pending_processing'
-                    }
-                    processing_results.append(result)
-                    
-                    logger.info(f"📧 Email en cola de procesamiento: {email['from']}")
-                    
-                except Exception as e:
-                    logger.error(f"❌ Error procesando email de {email['from']}: {e}")
-                    processing_results.append({
-                        'from': email['from'],
-                        'status': 'error',
-                        'error': str(e)
-                    })
-            
-            return processing_results
-            
-        except Exception as e:
-            logger.error(f"💥 Error crítico en procesamiento de emails: {e}")
-            return []
 
 email_processor = EmailProcessor()
\ No newline at end of file
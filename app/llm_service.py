@@ -1,11 +1,106 @@
-from openai import OpenAI
 from app.config import settings
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Tuple
+import asyncio
 import logging
+import hashlib
 import json
 import re
+import time
+
+# orjson decodifica más rápido; si no está instalado uso la librería estándar
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+__all__ = ['LLMService', 'llm_service', 'get_llm_service']
 
 logger = logging.getLogger(__name__)
 
+_REQUIRED_KEYS = ("sql", "operation_type", "explanation")
+
+# Normalización de la clave de caché (se ejecuta en cada solicitud)
+_PUNCTUATION_RE = re.compile(r'[^\w\s@]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Partes del email que no aportan a la solicitud: citas, firma e historial
+_QUOTED_LINE_RE = re.compile(r'^[ \t]*>.*$', re.MULTILINE)
+_SIGNATURE_OR_REPLY_RE = re.compile(r'^(?:--[ \t]*|(?:El|On) .+ (?:escribió|wrote):[ \t]*)$', re.MULTILINE)
+
+def _extract_json_span(text: str):
+    """
+    Devolver el primer objeto JSON balanceado dentro de text, o None.
+    
+    Una sola pasada contando llaves (ignorando las de dentro de strings)
+    cubre los tres casos: bloque ```json, bloque ``` genérico y JSON
+    rodeado de texto, sin regex ni backtracking.
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return None
+
+class _JsonObjectScanner:
+    """
+    Detecta cuándo el texto recibido por streaming ya contiene un objeto JSON completo.
+    
+    Cuento llaves ignorando las que van dentro de strings, así puedo cortar
+    el stream en cuanto cierra el objeto sin esperar texto sobrante.
+    """
+    __slots__ = ("depth", "started", "in_string", "escaped")
+    
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+    
+    def feed(self, text: str) -> bool:
+        """Procesar un fragmento; True si el primer objeto JSON ya está balanceado"""
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '{':
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
 class LLMService:
     """
     Servicio para procesamiento de lenguaje natural usando OpenAI.
@@ -15,12 +110,91 @@ class LLMService:
     - Temperature baja (0.1) para SQL consistente
     - Chain-of-thought para mejor razonamiento
     - Few-shot learning con ejemplos específicos
+    - Caché local para solicitudes idempotentes repetidas (listar libros)
     """
     
+    # Solo cacheo operaciones de lectura: reservar o renovar dos veces no es idempotente
+    _CACHEABLE_OPERATIONS = frozenset({"LIST_BOOKS"})
+    _SQL_CACHE_MAXSIZE = 1024
+    _SQL_CACHE_TTL = 3600  # segundos
+    _FALLBACK_SQL = "SELECT * FROM books WHERE available = 1"
+    _MAX_CONCURRENT_REQUESTS = 10  # respeta los rate limits de OpenAI
+    _TEST_CONNECTION_TTL = 30  # segundos
+    # Modelos que aceptan response_format=json_object (gpt-4 base no lo soporta)
+    _JSON_MODE_MODELS = ("gpt-4o", "gpt-4-turbo", "gpt-4.1", "gpt-4-1106", "gpt-4-0125", "gpt-3.5-turbo")
+    
+    # Respuestas al usuario por (tipo de operación, éxito)
+    _RESPONSE_TEMPLATES = {
+        ("RESERVE_BOOK", True): "¡Hola! Recibí tu solicitud para reservar un libro. ✅ La reserva se realizó exitosamente. El libro estará disponible para ti durante 14 días.",
+        ("RESERVE_BOOK", False): "¡Hola! Recibí tu solicitud para reservar. ❌ No pude completar la reserva. El libro podría no estar disponible o ya tienes una reserva activa.",
+    }
+    
+    # Prompts constantes: se construyen una sola vez al importar el módulo
+    _SYSTEM_PROMPT_SQL = """
+        Eres un asistente que convierte español a SQL. Responde SOLO con JSON.
+
+        Ejemplos:
+
+        {
+            "sql": "INSERT INTO reservations (book_id, user_email, reserved_at, expires_at) SELECT id, 'usuario@email.com', GETDATE(), DATEADD(day, 14, GETDATE()) FROM books WHERE title = '1984' AND author = 'George Orwell' AND available = 1",
+            "operation_type": "RESERVE_BOOK", 
+            "explanation": "Usuario quiere reservar '1984' de George Orwell"
+        }
+
+        Tablas: books (id, title, author, isbn, created_at, available)
+                reservations (id, book_id, user_email, reserved_at, renewed_at, expires_at, active)
+
+        Para cada mensaje con USER_EMAIL y USER_REQUEST sigue este proceso paso a paso:
+
+        PASO 1 - Identificar intención del usuario
+        PASO 2 - Extraer libro, autor y detalles  
+        PASO 3 - Determinar operación (reservar, renovar, etc.)
+        PASO 4 - Construir SQL con validaciones
+        PASO 5 - Verificar que sea seguro
+
+        Responde ÚNICAMENTE con JSON válido.
+        """
+    # Solo los datos variables, sin sangría ni relleno: todo lo fijo va en el prompt del sistema
+    _USER_PROMPT_TEMPLATE = 'USER_EMAIL: {user_email}\nUSER_REQUEST: "{user_request}"'
+    # Clave estable por versión del prompt del sistema: enruta las peticiones
+    # al mismo shard de la caché de prompts de OpenAI. OJO: OpenAI solo cachea
+    # prefijos de 1024 tokens o más y este prompt ronda los 300, así que hoy no
+    # hay caché; la clave y el prefijo estático cuentan cuando el prompt crezca.
+    _PROMPT_CACHE_KEY = "sql-" + hashlib.sha256(_SYSTEM_PROMPT_SQL.encode("utf-8")).hexdigest()[:16]
+    
     def __init__(self):
+        # Import diferido: openai/httpx son pesados y solo hacen falta
+        # cuando realmente se usa el servicio
+        from openai import AsyncOpenAI
+        import httpx
+        
         # ✅ Mantener nombres originales para compatibilidad
-        self.client = OpenAI(api_key=settings.openai_api_key)
+        # Cliente async: la llamada a OpenAI no bloquea el event loop de FastAPI
+        # Pool HTTP propio y acotado: HTTP/2 multiplexa las llamadas sobre una
+        # sola conexión TLS y los timeouts explícitos evitan esperas colgadas
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(connect=5, read=30, write=10, pool=5)
+        )
+        self.client = AsyncOpenAI(api_key=settings.openai_api_key, http_client=self._http)
         self.model = settings.openai_model
+        self._json_mode_kwargs = (
+            {"response_format": {"type": "json_object"}}
+            if self.model.startswith(self._JSON_MODE_MODELS) else {}
+        )
+        # digest(solicitud normalizada, email) -> (expira_en, resultado), en orden LRU
+        self._sql_cache = OrderedDict()
+        # Límite de llamadas simultáneas a OpenAI por instancia
+        self._sem = asyncio.Semaphore(self._MAX_CONCURRENT_REQUESTS)
+        # Último resultado de test_connection (para no consultar OpenAI en cada healthcheck).
+        # None = nunca probado: 0.0 fallaría si monotonic() aún está por debajo del TTL
+        self._last_test_ts = None
+        self._last_test_result = False
+    
+    async def aclose(self):
+        """Cerrar el pool HTTP hacia OpenAI (al apagar la aplicación)"""
+        await self._http.aclose()
     
     async def natural_language_to_sql(self, user_request: str, user_email: str) -> dict:
         """
@@ -33,21 +207,16 @@ class LLMService:
         Returns:
             Dict con SQL, tipo de operación y explicación
         """
+        cache_key = self._cache_key(user_request, user_email)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.debug("⚡ Solicitud resuelta desde caché (sin llamar a OpenAI)")
+            return cached
+        
         try:
-            prompt = self._build_cot_prompt(user_request, user_email)
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": self._get_system_prompt()},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1,  # Baja temperatura para SQL consistente
-                max_tokens=800
-            )
-            
-            sql_response = response.choices[0].message.content.strip()
-            return self._parse_sql_response(sql_response)
+            result = await self._call_llm(user_request, user_email)
+            self._cache_put(cache_key, result)
+            return result
             
         except Exception as e:
             logger.error(f"❌ Error en OpenAI: {e}")
@@ -57,41 +226,148 @@ class LLMService:
                 "explanation": f"Error procesando solicitud: {str(e)}"
             }
     
-    def _build_cot_prompt(self, user_request: str, user_email: str) -> str:
-        """Construir prompt con chain-of-thought"""
-        return f"""
-        USER_EMAIL: {user_email}
-        USER_REQUEST: "{user_request}"
-
-        Sigue este proceso paso a paso:
-
-        PASO 1 - Identificar intención del usuario
-        PASO 2 - Extraer libro, autor y detalles  
-        PASO 3 - Determinar operación (reservar, renovar, etc.)
-        PASO 4 - Construir SQL con validaciones
-        PASO 5 - Verificar que sea seguro
-
-        Aplica estos pasos a la solicitud.
+    async def natural_language_to_sql_batch(self, items: List[Tuple[str, str]]) -> List[dict]:
         """
+        Convertir varias solicitudes a SQL de forma concurrente.
+        
+        Uso asyncio.gather porque:
+        - El tiempo total pasa de N×latencia a ~1×latencia de OpenAI
+        - El semáforo de la instancia limita las llamadas en vuelo
+        - return_exceptions evita que un fallo cancele el resto del lote
+        
+        Args:
+            items: Lista de tuplas (user_request, user_email)
+            
+        Returns:
+            Lista de dicts en el mismo orden que items
+        """
+        results = await asyncio.gather(
+            *(self.natural_language_to_sql(request, email) for request, email in items),
+            return_exceptions=True
+        )
+        return [
+            {
+                "sql": None,
+                "operation_type": "error",
+                "explanation": f"Error procesando solicitud: {str(result)}"
+            } if isinstance(result, BaseException) else result
+            for result in results
+        ]
     
-    def _get_system_prompt(self) -> str:
-        """Prompt del sistema con ejemplos específicos"""
-        return """
-        Eres un asistente que convierte español a SQL. Responde SOLO con JSON.
-
-        Ejemplos:
-
-        {
-            "sql": "INSERT INTO reservations (book_id, user_email, reserved_at, expires_at) SELECT id, 'usuario@email.com', GETDATE(), DATEADD(day, 14, GETDATE()) FROM books WHERE title = '1984' AND author = 'George Orwell' AND available = 1",
-            "operation_type": "RESERVE_BOOK", 
-            "explanation": "Usuario quiere reservar '1984' de George Orwell"
-        }
-
-        Tablas: books (id, title, author, isbn, created_at, available)
-                reservations (id, book_id, user_email, reserved_at, renewed_at, expires_at, active)
-
-        Responde ÚNICAMENTE con JSON válido.
+    async def _call_llm(self, user_request: str, user_email: str) -> dict:
+        """Llamar a OpenAI y parsear la respuesta a dict de SQL"""
+        prompt = self._build_cot_prompt(user_request, user_email)
+        
+        chunks = []
+        scanner = _JsonObjectScanner()
+        async with self._sem:
+            # Streaming: en cuanto el objeto JSON cierra dejo de leer y no
+            # espero el texto explicativo que el modelo añada después
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self._SYSTEM_PROMPT_SQL},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.1,  # Baja temperatura para SQL consistente
+                max_tokens=300,  # el JSON de respuesta rara vez pasa de 200 tokens
+                stop=["\n\n\n"],
+                stream=True,
+                extra_body={"prompt_cache_key": self._PROMPT_CACHE_KEY},
+                **self._json_mode_kwargs
+            )
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        chunks.append(delta)
+                        if scanner.feed(delta):
+                            break
+            finally:
+                await stream.close()
+        
+        sql_response = "".join(chunks).strip()
+        return self._parse_sql_response(sql_response)
+    
+    @staticmethod
+    def trim_request(body: str, max_chars: int) -> str:
+        """
+        Recortar el cuerpo del email antes de enviarlo a OpenAI.
+        
+        Los usuarios responden citando correos anteriores y con firma:
+        eso duplica los tokens (coste y latencia) sin cambiar la solicitud.
+        - Corto en la firma ("-- ") o en la cabecera de respuesta ("El ... escribió:")
+        - Quito las líneas citadas con ">"
+        - Colapso espacios y limito a max_chars
         """
+        match = _SIGNATURE_OR_REPLY_RE.search(body)
+        text = body[:match.start()] if match else body
+        text = _WHITESPACE_RE.sub(' ', _QUOTED_LINE_RE.sub('', text)).strip()
+        if not text:
+            # Todo era cita o firma: mejor el original que nada
+            text = _WHITESPACE_RE.sub(' ', body).strip()
+        return text[:max_chars]
+    
+    @staticmethod
+    def _normalize_request(user_request: str) -> str:
+        """Normalizar la solicitud para la clave de caché (minúsculas, sin puntuación)"""
+        text = _PUNCTUATION_RE.sub('', user_request.lower())
+        return _WHITESPACE_RE.sub(' ', text).strip()
+    
+    @classmethod
+    def _cache_key(cls, user_request: str, user_email: str) -> bytes:
+        """
+        Clave de caché de tamaño fijo para (solicitud, email).
+        
+        Uso un digest blake2b de 16 bytes en lugar del texto porque:
+        - Un cuerpo de email largo no se queda retenido como clave
+        - Comparar y hashear 16 bytes es más barato que un string largo
+        - blake2b es el hash más rápido de hashlib en CPython
+        """
+        normalized = cls._normalize_request(user_request)
+        return hashlib.blake2b(
+            f"{normalized}\0{user_email}".encode("utf-8"), digest_size=16
+        ).digest()
+    
+    def _cache_get(self, key):
+        """Obtener un resultado cacheado vigente (o None)"""
+        entry = self._sql_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self._sql_cache[key]
+            return None
+        self._sql_cache.move_to_end(key)
+        return dict(result)
+    
+    def _cache_put(self, key, result: dict):
+        """
+        Guardar un resultado si es cacheable.
+        
+        No cacheo el SQL genérico de respaldo: puede venir de un fallo de
+        parseo y un nuevo intento podría entender mejor la solicitud.
+        """
+        if (result.get("operation_type") not in self._CACHEABLE_OPERATIONS
+                or not result.get("sql") or result["sql"] == self._FALLBACK_SQL):
+            return
+        self._sql_cache[key] = (time.monotonic() + self._SQL_CACHE_TTL, dict(result))
+        self._sql_cache.move_to_end(key)
+        while len(self._sql_cache) > self._SQL_CACHE_MAXSIZE:
+            self._sql_cache.popitem(last=False)
+    
+    def _build_cot_prompt(self, user_request: str, user_email: str) -> str:
+        """
+        Construir el mensaje del usuario: solo los datos variables.
+        
+        Las instrucciones fijas del chain-of-thought viven en el prompt del
+        sistema porque la caché de prompts de OpenAI solo reutiliza prefijos
+        idénticos: lo estático va primero y lo dinámico al final. (La caché
+        exige un prefijo de al menos 1024 tokens; ver _PROMPT_CACHE_KEY.)
+        """
+        return self._USER_PROMPT_TEMPLATE.format(user_email=user_email, user_request=user_request)
     
     async def format_response_to_natural_language(self, sql_result: any, operation_type: str, user_request: str) -> str:
         """
@@ -101,12 +377,11 @@ class LLMService:
         en lugar de mensajes genéricos.
         """
         try:
-            # Lógica existente de formateo
-            if operation_type == "RESERVE_BOOK":
-                if isinstance(sql_result, dict) and sql_result.get("rows_affected", 0) > 0:
-                    return f"¡Hola! Recibí tu solicitud para reservar un libro. ✅ La reserva se realizó exitosamente. El libro estará disponible para ti durante 14 días."
-                else:
-                    return f"¡Hola! Recibí tu solicitud para reservar. ❌ No pude completar la reserva. El libro podría no estar disponible o ya tienes una reserva activa."
+            # Despacho por tabla: respuestas deterministas, sin llamar a OpenAI
+            success = isinstance(sql_result, dict) and sql_result.get("rows_affected", 0) > 0
+            template = self._RESPONSE_TEMPLATES.get((operation_type, success))
+            if template is not None:
+                return template.format(user_request=user_request)
             
             # Respuestas para otros tipos de operaciones...
             return f"¡Hola! Procesé tu solicitud: '{user_request}'. El resultado fue: {sql_result}"
@@ -115,21 +390,67 @@ class LLMService:
             logger.error(f"Error formateando respuesta: {e}")
             return f"¡Hola! Procesé tu solicitud: '{user_request}'."
     
+    async def test_connection(self) -> bool:
+        """
+        Verificar conectividad con OpenAI.
+        
+        Uso models.list() en lugar de una completion porque:
+        - No genera tokens ni se factura
+        - Cualquier respuesta autenticada prueba la conexión
+        
+        El resultado se cachea unos segundos: un balanceador que consulta
+        el estado cada pocos segundos no debe pagar un round trip cada vez.
+        """
+        if (self._last_test_ts is not None
+                and time.monotonic() - self._last_test_ts < self._TEST_CONNECTION_TTL):
+            return self._last_test_result
+        
+        try:
+            await self.client.models.list()
+            result = True
+        except Exception as e:
+            logger.error(f"❌ Error conectando con OpenAI: {e}")
+            result = False
+        
+        self._last_test_ts = time.monotonic()
+        self._last_test_result = result
+        return result
+    
     def _parse_sql_response(self, response: str) -> dict:
         """Parsear respuesta de OpenAI - manteniendo lógica existente"""
         try:
-            # Lógica de parsing existente
             cleaned_response = response.strip()
-            json_match = re.search(r'(\{.*\})', cleaned_response, re.DOTALL)
             
-            if json_match:
-                parsed = json.loads(json_match.group(1))
-                if all(key in parsed for key in ["sql", "operation_type", "explanation"]):
+            # Camino feliz: el modelo casi siempre devuelve JSON puro, sin regex
+            if cleaned_response.startswith('{'):
+                try:
+                    parsed = _json_loads(cleaned_response)
+                    if all(key in parsed for key in _REQUIRED_KEYS):
+                        return parsed
+                except ValueError:  # orjson.JSONDecodeError hereda de ValueError
+                    pass
+            
+            # Respaldo: JSON dentro de un bloque ``` o rodeado de texto.
+            # Primero el recorte entre la primera '{' y la última '}' (dos
+            # búsquedas en C); si no parsea, el escaneo de llaves
+            start, end = cleaned_response.find('{'), cleaned_response.rfind('}')
+            if start != -1 and end > start:
+                try:
+                    parsed = _json_loads(cleaned_response[start:end + 1])
+                    if all(key in parsed for key in _REQUIRED_KEYS):
+                        return parsed
+                except ValueError:
+                    pass
+            
+            json_span = _extract_json_span(cleaned_response)
+            if json_span is not None:
+                parsed = _json_loads(json_span)
+                if all(key in parsed for key in _REQUIRED_KEYS):
                     return parsed
             
             # Fallback si el parsing falla
             return {
-                "sql": "SELECT * FROM books WHERE available = 1",
+                "sql": self._FALLBACK_SQL,
                 "operation_type": "LIST_BOOKS", 
                 "explanation": "No se pudo parsear la respuesta correctamente"
             }
@@ -137,9 +458,23 @@ class LLMService:
         except Exception as e:
             logger.error(f"Error parseando respuesta: {e}")
             return {
-                "sql": "SELECT * FROM books WHERE available = 1",
+                "sql": self._FALLBACK_SQL,
                 "operation_type": "LIST_BOOKS",
                 "explanation": f"Error: {str(e)}"
             }
 
-llm_service = LLMService()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_llm_service() -> LLMService:
+    """
+    Instancia única de LLMService por proceso, creada al primer uso.
+    
+    Así importar app.llm_service no construye el cliente de OpenAI ni su
+    pool HTTP en procesos que nunca llaman al LLM (scripts, tests).
+    """
+    return LLMService()
+
+def __getattr__(name):
+    # ✅ MANTENER nombre original: `from app.llm_service import llm_service` sigue funcionando
+    if name == 'llm_service':
+        return get_llm_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
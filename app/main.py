@@ -1,24 +1,92 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, status
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from app.database import db
+from app.database import db, parameterize_sql, classify_sql
 from app.email_processor import email_processor
-from app.llm_service import llm_service  # ✅ Mantener import original
-from app.models import EmailRequest, OperationResult
+from app.llm_service import get_llm_service
+from app.models import EmailRequest, OperationResult, ProcessEmailsResponse, SystemStatus
 from app.config import settings
+from contextlib import asynccontextmanager
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
-from typing import List, Dict
-import re
+import queue
+from typing import Dict
 
+def _configure_logging():
+    """
+    Logging no bloqueante: los handlers corren en un hilo aparte.
+    
+    Uso QueueHandler + QueueListener porque:
+    - Con muchos emails en paralelo, escribir en stdout bajo el GIL frena el event loop
+    - Encolar un registro es casi gratis; el formateo y la escritura van en otro hilo
+    
+    Si el entorno ya configuró logging (tests, otro servidor) no lo toco.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # httpx y openai registran en INFO cada petición y reintento: uno por email
+    for name in ("httpx", "openai"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+_log_listener = _configure_logging()
 logger = logging.getLogger(__name__)
 
+# Estado del sistema: se refresca en segundo plano, /status solo lee el último
+_STATUS_REFRESH_SECONDS = 30
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo de vida de la aplicación (reemplaza on_event startup/shutdown).
+    
+    - El esquema y el pool de BD se preparan en paralelo, cada uno en un hilo
+    - Al salir se cancela el refresco de estado y se cierran los clientes
+    """
+    app.state.system_status = {
+        "database": False,
+        "email_service": False,
+        "openai": False,
+        "overall": False
+    }
+    try:
+        # Esquema y pool en paralelo: las primeras peticiones no pagan el login TDS
+        await asyncio.gather(
+            asyncio.to_thread(db.init_database),
+            asyncio.to_thread(db.warm_pool)
+        )
+        logger.info("✅ Aplicación iniciada correctamente")
+    except Exception as e:
+        logger.error(f"❌ Error en startup: {e}")
+    status_task = asyncio.create_task(_refresh_status_loop())
+    
+    yield
+    
+    # Liberar conexiones abiertas hacia servicios externos. Espero a que la
+    # tarea termine: un test_connection en vuelo no debe usar un cliente cerrado
+    status_task.cancel()
+    await asyncio.gather(status_task, return_exceptions=True)
+    # Solo si el servicio llegó a construirse: no crear un cliente para cerrarlo
+    if get_llm_service.cache_info().currsize:
+        await get_llm_service().aclose()
+    if _log_listener is not None:
+        _log_listener.stop()  # vacía la cola antes de salir
+
 app = FastAPI(
     title="Library Email Automation API",
     description="Sistema automatizado de gestión de biblioteca por email",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -29,14 +97,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-async def startup_event():
-    """Inicializar aplicación - manteniendo funcionalidad existente"""
-    try:
-        db.init_database()
-        logger.info("✅ Aplicación iniciada correctamente")
-    except Exception as e:
-        logger.error(f"❌ Error en startup: {e}")
+async def _refresh_status_loop():
+    """
+    Refrescar el estado del sistema cada _STATUS_REFRESH_SECONDS.
+    
+    Lo hago en segundo plano porque:
+    - Un monitor que consulta /status no debe disparar tráfico a OpenAI, IMAP y BD
+    - La respuesta de /status pasa a ser una lectura en memoria
+    
+    OpenAI solo se prueba si el servicio ya se construyó (primer email):
+    el refresco no debe crear el cliente que get_llm_service difiere.
+    Hasta entonces se conserva el último valor conocido.
+    """
+    while True:
+        try:
+            if get_llm_service.cache_info().currsize:
+                openai_check = get_llm_service().test_connection()
+            else:
+                # sleep(0, valor) devuelve el último estado sin tocar la red
+                openai_check = asyncio.sleep(0, app.state.system_status["openai"])
+            checks = await asyncio.gather(
+                asyncio.to_thread(db.test_connection),
+                email_processor.test_connection(),
+                openai_check,
+                return_exceptions=True
+            )
+            database, email_service, openai = (check is True for check in checks)
+            app.state.system_status = {
+                "database": database,
+                "email_service": email_service,
+                "openai": openai,
+                "overall": database and email_service and openai
+            }
+        except Exception as e:
+            logger.error(f"Error en status check: {e}")
+        await asyncio.sleep(_STATUS_REFRESH_SECONDS)
 
 @app.get("/")
 async def root():
@@ -56,23 +151,23 @@ async def process_single_email(email_data: EmailRequest):
     - Manejo robusto de errores con respuestas informativas
     - Separación clara de responsabilidades
     """
-    try:
-        # Validación mejorada manteniendo la interfaz existente
-        if not email_data.from_email or "@" not in email_data.from_email:
-            return OperationResult(
-                success=False,
-                message="Email del remitente no válido"
-            )
-
-        if not email_data.subject.strip() or not email_data.body.strip():
-            return OperationResult(
-                success=False,
-                message="El asunto y el cuerpo del mensaje no pueden estar vacíos"
-            )
+    # EmailRequest ya validó remitente, asunto y cuerpo (si no, FastAPI responde 422)
+    return await _process_email_core(email_data)
 
+async def _process_email_core(email_data: EmailRequest) -> OperationResult:
+    """
+    Núcleo del procesamiento: LLM -> SQL -> respuesta -> SMTP.
+    
+    Lo comparten el endpoint individual y el lote; el lote lo llama
+    directamente con el EmailRequest ya validado, sin pasar por el endpoint.
+    """
+    try:
         # ✅ Usar función original del LLM service
+        llm_service = get_llm_service()
+        # Sin citas, firma ni espacios sobrantes: menos tokens por email
+        user_request = llm_service.trim_request(email_data.body, settings.llm_max_input_chars)
         llm_result = await llm_service.natural_language_to_sql(
-            email_data.body, 
+            user_request, 
             email_data.from_email
         )
         
@@ -121,58 +216,137 @@ async def process_single_email(email_data: EmailRequest):
             message=f"Error procesando email: {str(e)}"
         )
 
+# Un solo lote de emails a la vez por proceso
+_batch_lock = asyncio.Lock()
+
+@app.post("/api/process-emails", response_model=ProcessEmailsResponse)
+async def process_pending_emails():
+    """
+    Procesar todos los emails no leídos del buzón.
+    
+    Decisiones de diseño:
+    - Cada email es independiente: se procesan en paralelo con asyncio.gather
+    - Un semáforo limita las llamadas simultáneas a OpenAI (rate limits)
+    - return_exceptions evita que un email defectuoso tumbe el lote
+    - Al leerlos, los emails se reclaman en el buzón con la keyword $Processing
+      (el SEARCH la excluye) y se marcan como leídos al terminar el lote
+    - Cada Message-ID se registra en la BD antes de procesarlo: con varios
+      workers, o si el proveedor entrega dos veces, solo uno lo procesa
+    - Un solo lote a la vez por proceso
+    """
+    if _batch_lock.locked():
+        return ProcessEmailsResponse(
+            success=False,
+            message="Ya hay un lote de emails en proceso",
+            emails_processed=0
+        )
+    
+    async with _batch_lock:
+        return await _process_pending_batch()
+
+async def _process_pending_batch() -> ProcessEmailsResponse:
+    """Procesar el lote de no leídos y marcarlo como leído al terminar"""
+    emails = await email_processor.fetch_unread_emails(mark_seen=False)
+    # Un solo reclamo por lote: una conexión (y un backoff si la BD no responde)
+    message_ids = [email['message_id'] for email in emails if email['message_id']]
+    claimed = await asyncio.to_thread(db.claim_messages, message_ids) if message_ids else set()
+    semaphore = asyncio.Semaphore(settings.openai_concurrency)
+    
+    async def handle(email: Dict) -> OperationResult:
+        async with semaphore:
+            # Sin Message-ID no hay con qué deduplicar: se procesa igual
+            if email['message_id'] and email['message_id'] not in claimed:
+                logger.debug(f"⏭️ Email ya procesado, se omite: {email['message_id']}")
+                return OperationResult(success=True, message="Email ya procesado anteriormente")
+            # EmailRequest valida los datos del buzón (vienen de fuera);
+            # el núcleo se llama directo, sin el prólogo del endpoint
+            return await _process_email_core(EmailRequest(
+                subject=email['subject'],
+                body=email['body'],
+                from_email=email['from']
+            ))
+    
+    outcomes = await asyncio.gather(
+        *(handle(email) for email in emails),
+        return_exceptions=True
+    )
+    
+    details = []
+    for email, outcome in zip(emails, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"❌ Error procesando email de {email['from']}: {outcome}")
+            details.append({"from": email['from'], "success": False, "message": str(outcome)})
+        else:
+            details.append({"from": email['from'], "success": outcome.success, "message": outcome.message})
+    
+    # Un único STORE al final: los fallos de validación tampoco se reintentan
+    await email_processor.mark_seen([email['uid'] for email in emails])
+    
+    return ProcessEmailsResponse(
+        success=True,
+        message=f"{len(emails)} emails procesados",
+        emails_processed=len(emails),
+        details=details
+    )
+
 # ✅ MANTENER funciones auxiliares existentes
 async def execute_sql_query(sql: str):
-    """Ejecutar consulta SQL con manejo robusto de errores"""
+    """
+    Ejecutar consulta SQL con manejo robusto de errores.
+    
+    La conexión sale del pool sin bloquear el event loop; la consulta y la
+    devolución al pool (rollback incluido) corren en un hilo: pyodbc es
+    síncrono y un SELECT lento no debe frenar al resto de peticiones.
+    """
+    # Allowlist antes de tocar la BD: el SQL viene de un LLM
+    statement_type = classify_sql(sql)
+    if statement_type is None:
+        logger.warning(f"🚫 SQL rechazado: {sql[:100]}...")
+        return {"error": "Consulta SQL no permitida"}
+    
     try:
-        conn = db.get_connection()
+        conn = await db.get_connection_async()
+        return await asyncio.to_thread(_run_sql, conn, sql, statement_type)
+            
+    except Exception as e:
+        logger.error(f"❌ Error ejecutando SQL: {e}")
+        return {"error": str(e)}
+
+def _run_sql(conn, sql: str, statement_type: str):
+    """
+    Parte bloqueante de execute_sql_query (se ejecuta en un hilo).
+    
+    El with también va aquí: al salir devuelve la conexión al pool con un
+    rollback, otro round trip ODBC que no debe correr en el event loop.
+    """
+    with conn:
         cursor = conn.cursor()
         
-        logger.info(f"🔍 Ejecutando SQL: {sql[:100]}...")
+        logger.debug(f"🔍 Ejecutando SQL: {sql[:100]}...")
         
-        cursor.execute(sql)
+        # Literales como parámetros: plan reutilizable y sin inyección vía texto
+        statement, params = parameterize_sql(sql)
+        cursor.execute(statement, params)
         
-        if sql.strip().upper().startswith('SELECT'):
-            results = cursor.fetchall()
-            # Convertir a formato legible
-            if hasattr(results, '__iter__'):
-                return [dict(row) for row in results]
-            return []
+        if statement_type == 'SELECT':
+            # Tope de filas: un SELECT sin filtro generado por el LLM no debe
+            # cargar la tabla entera en memoria (el driver no trae el resto)
+            results = cursor.fetchmany(settings.sql_max_rows)
+            # Convertir a formato legible: las filas de pyodbc son secuencias,
+            # los nombres de columna salen una sola vez de cursor.description
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in results]
         else:
             conn.commit()
             return {"rows_affected": cursor.rowcount}
-            
-    except Exception as e:
-        logger.error(f"❌ Error ejecutando SQL: {e}")
-        return {"error": str(e)}
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-        except:
-            pass
 
 # ✅ MANTENER endpoints existentes
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "library_email_api"}
 
-@app.get("/status")
+@app.get("/status", response_model=SystemStatus)
 async def system_status():
     """Estado del sistema - manteniendo estructura de respuesta"""
-    try:
-        # Lógica existente de verificación de estado
-        return {
-            "database": True,
-            "email_service": True, 
-            "openai": True,
-            "overall": True
-        }
-    except Exception as e:
-        logger.error(f"Error en status check: {e}")
-        return {
-            "database": False,
-            "email_service": False,
-            "openai": False, 
-            "overall": False
-        }
\ No newline at end of file
+    # Último resultado del refresco en segundo plano (sin llamadas externas)
+    return app.state.system_status
\ No newline at end of file
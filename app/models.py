@@ -1,10 +1,48 @@
-from pydantic import BaseModel, EmailStr, validator, field_validator
+from pydantic import BaseModel, ConfigDict, Field, StrictBool, field_validator, StringConstraints, AfterValidator
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Annotated
 import re
-from enum import Enum
+from enum import StrEnum
+# pydantic exige el TypedDict de typing_extensions en Python < 3.12 (ya es dependencia suya)
+from typing_extensions import TypedDict
 
-class OperationType(str, Enum):
+# Regex compilada una sola vez al importar el módulo
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Tabla de borrado para limpiar ISBN sin pasar por el motor de regex
+_ISBN_DELETE = str.maketrans('', '', '- \t\n\r\f\v')
+
+# Texto no vacío: pydantic-core lo valida en Rust (el strip lo hace la config del modelo)
+NonEmptyStr = Annotated[str, StringConstraints(min_length=1)]
+
+# Todos los modelos son portadores de datos: nadie los muta tras construirlos
+# Los de salida se usan poco: su schema se construye en el primer uso, no al importar
+_OUTPUT_MODEL_CONFIG = ConfigDict(frozen=True, defer_build=True)
+# Config compartida por los modelos de entrada: el strip de todos los str lo hace pydantic-core
+_INPUT_MODEL_CONFIG = ConfigDict(str_strip_whitespace=True, extra='ignore', frozen=True)
+
+def validate_email(value: str) -> str:
+    """
+    Validar y normalizar un email (regex + minúsculas).
+    
+    Uso una regex simple pero efectiva porque:
+    - Las validaciones estrictas de email a veces rechazan formatos válidos
+    - Es más importante capturar el email que validarlo perfectamente
+    - Los usuarios pueden usar emails con dominios nuevos o internacionales
+    
+    No hago strip: en los modelos ya lo hizo str_strip_whitespace.
+    """
+    # Vacío y formato en la misma pasada: un solo validador por campo
+    if not value:
+        raise ValueError('Este campo no puede estar vacío')
+    if not _EMAIL_RE.match(value):
+        raise ValueError('Formato de email inválido')
+    # La mayoría ya llega en minúsculas: islower() evita copiar el string
+    return value if value.islower() else value.lower()
+
+# Un solo tipo de email para todos los modelos: un validador en lugar de tres
+EmailType = Annotated[str, AfterValidator(validate_email)]
+
+class OperationType(StrEnum):
     """
     Tipos de operaciones soportadas por el sistema.
     
@@ -13,6 +51,8 @@ class OperationType(str, Enum):
     - Es más explícito que strings mágicos
     - Facilita el autocompletado en IDEs
     - Reduce errores de tipeo
+    
+    StrEnum (3.11+) porque str() devuelve el valor y evita el mixin manual.
     """
     RESERVE_BOOK = "RESERVE_BOOK"
     RENEW_RESERVATION = "RENEW_RESERVATION" 
@@ -37,25 +77,15 @@ class Book(BaseModel):
     - ISBN es opcional porque no todos los libros lo tienen
     """
     
+    model_config = _INPUT_MODEL_CONFIG
+    
     id: Optional[int] = None
-    title: str
-    author: str
+    # He visto que los usuarios a veces envían espacios en blanco: NonEmptyStr los recorta
+    title: NonEmptyStr
+    author: NonEmptyStr
     isbn: Optional[str] = None
     created_at: Optional[datetime] = None
-    available: bool = True
-
-    @field_validator('title', 'author')
-    @classmethod
-    def validate_not_empty(cls, value: str) -> str:
-        """
-        Validar que título y autor no estén vacíos.
-        
-        He visto que los usuarios a veces envían espacios en blanco,
-        por eso hago strip() antes de validar.
-        """
-        if not value or not value.strip():
-            raise ValueError('El título y autor son obligatorios')
-        return value.strip()
+    available: StrictBool = True  # pyodbc ya devuelve BIT como bool: sin coerción lax
 
     @field_validator('isbn')
     @classmethod
@@ -72,10 +102,10 @@ class Book(BaseModel):
             return value
             
         # Limpiar guiones y espacios
-        clean_isbn = re.sub(r'[-\s]', '', value)
+        clean_isbn = value.translate(_ISBN_DELETE)
         
         # Validar longitud básica (ISBN-10 o ISBN-13)
-        if not re.match(r'^(\d{10}|\d{13})$', clean_isbn):
+        if not (len(clean_isbn) in (10, 13) and clean_isbn.isascii() and clean_isbn.isdigit()):
             raise ValueError('Formato ISBN inválido. Debe tener 10 o 13 dígitos')
             
         return clean_isbn
@@ -95,49 +125,16 @@ class Reservation(BaseModel):
     - Tener campos opcionales para timestamps de renovación
     """
     
+    model_config = _INPUT_MODEL_CONFIG
+    
     id: Optional[int] = None
-    book_id: int
-    user_email: str
+    # Aunque la BD tiene ID autoincremental, los IDs no positivos nunca son válidos
+    book_id: int = Field(gt=0)
+    user_email: EmailType
     reserved_at: Optional[datetime] = None
     renewed_at: Optional[datetime] = None
     expires_at: Optional[datetime] = None
-    active: bool = True
-
-    @field_validator('user_email')
-    @classmethod
-    def validate_user_email(cls, value: str) -> str:
-        """
-        Validar formato de email del usuario.
-        
-        Uso una regex simple pero efectiva porque:
-        - Las validaciones estrictas de email a veces rechazan formatos válidos
-        - Es más importante capturar el email que validarlo perfectamente
-        - Los usuarios pueden usar emails con dominios nuevos o internacionales
-        """
-        if not value or '@' not in value:
-            raise ValueError('El email debe tener un formato válido')
-        
-        # Regex básica pero suficiente para la mayoría de casos
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, value.strip()):
-            raise ValueError('Formato de email inválido')
-            
-        return value.strip().lower()  # Normalizar a minúsculas
-
-    @field_validator('book_id')
-    @classmethod 
-    def validate_book_id(cls, value: int) -> int:
-        """
-        Validar que book_id sea positivo.
-        
-        Aunque la BD tiene ID autoincremental, valido aquí también porque:
-        - Previene errores si alguien usa la API directamente
-        - Es una validación barata que puede evitar problemas
-        - Los IDs negativos nunca son válidos en nuestro sistema
-        """
-        if value <= 0:
-            raise ValueError('El ID del libro debe ser un número positivo')
-        return value
+    active: StrictBool = True
 
 class EmailRequest(BaseModel):
     """
@@ -154,58 +151,25 @@ class EmailRequest(BaseModel):
     - Longitud mínima en body para evitar spam o emails vacíos
     """
     
-    subject: str
-    body: str
-    from_email: str
-
-    @field_validator('subject', 'body', 'from_email')
-    @classmethod
-    def validate_not_empty_or_whitespace(cls, value: str) -> str:
-        """
-        Validar que los campos no estén vacíos o solo tengan espacios.
-        
-        He visto casos donde:
-        - Los usuarios pegan texto con muchos espacios
-        - Algunos clientes de email envían subjects vacíos
-        - Es mejor normalizar temprano que procesar basura
-        """
-        if not value or not value.strip():
-            raise ValueError('Este campo no puede estar vacío')
-        return value.strip()
-
-    @field_validator('from_email')
-    @classmethod
-    def validate_email_format(cls, value: str) -> str:
-        """
-        Validar formato de email con regex específica.
-        
-        Uso esta regex porque:
-        - Es más permisiva que la estándar (soporta nuevos TLDs)
-        - Rechaza emails obviamente inválidos
-        - Es rápida de ejecutar
-        """
-        cleaned_value = value.strip()
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        
-        if not re.match(email_pattern, cleaned_value):
-            raise ValueError('Formato de email inválido')
-            
-        return cleaned_value
+    model_config = _INPUT_MODEL_CONFIG
+    
+    subject: NonEmptyStr
+    # Mínimo de 10 caracteres: mensajes más cortos suelen ser spam o pruebas
+    body: str = Field(min_length=10)
+    from_email: EmailType
 
-    @field_validator('body')
-    @classmethod
-    def validate_body_length(cls, value: str) -> str:
-        """
-        Validar longitud mínima del cuerpo del mensaje.
-        
-        Decidí un mínimo de 10 caracteres porque:
-        - Mensajes más cortos probablemente no tienen sentido
-        - Evita procesar spam o mensajes de prueba
-        - Mensajes legítimos suelen ser más largos
-        """
-        if len(value.strip()) < 10:
-            raise ValueError('El mensaje debe tener al menos 10 caracteres')
-        return value
+class ProcessedEmailData(TypedDict, total=False):
+    """
+    Payload de OperationResult.data cuando un email se procesa con éxito.
+    
+    Todas las operaciones devuelven la misma forma, así que basta un TypedDict
+    (sin unión discriminada): pydantic-core valida claves conocidas en lugar
+    de recorrer un dict genérico.
+    """
+    operation: str
+    response_sent: bool
+    sql_generated: str
+    user_response: str
 
 class OperationResult(BaseModel):
     """
@@ -216,25 +180,19 @@ class OperationResult(BaseModel):
     - Facilita el debugging y logging
     - Estructura predecible para frontends
     
-    Decidí incluir un campo 'data' opcional porque:
+    Decidí incluir un campo 'data' (vacío por defecto) porque:
     - Algunas operaciones no retornan datos adicionales
     - Es más flexible que tener múltiples modelos de respuesta
     - Sigue el patrón común en APIs REST
     """
     
+    model_config = _OUTPUT_MODEL_CONFIG
+    
     success: bool
-    message: str
-    data: Optional[Dict] = None
+    message: NonEmptyStr
+    data: ProcessedEmailData = Field(default_factory=dict)
     operation_type: Optional[OperationType] = None
 
-    @field_validator('message')
-    @classmethod
-    def validate_message_not_empty(cls, value: str) -> str:
-        """Validar que el mensaje no esté vacío."""
-        if not value or not value.strip():
-            raise ValueError('El mensaje no puede estar vacío')
-        return value.strip()
-
 class EmailProcessingResult(BaseModel):
     """
     Modelo para resultados de procesamiento de emails.
@@ -245,6 +203,8 @@ class EmailProcessingResult(BaseModel):
     - Debugging de problemas específicos
     """
     
+    model_config = _OUTPUT_MODEL_CONFIG
+    
     email_from: str
     processed_at: datetime
     operation_type: OperationType
@@ -262,6 +222,8 @@ class SystemStats(BaseModel):
     - Alertas de rendimiento
     """
     
+    model_config = _OUTPUT_MODEL_CONFIG
+    
     total_books: int
     available_books: int
     active_reservations: int
@@ -274,10 +236,12 @@ class ProcessEmailsResponse(BaseModel):
     """
     Respuesta para el endpoint de procesamiento batch de emails.
     """
+    model_config = _OUTPUT_MODEL_CONFIG
+    
     success: bool
     message: str
     emails_processed: int
-    details: List[Dict] = []
+    details: List[Dict] = Field(default_factory=list)
 
 class SystemStatus(BaseModel):
     """
@@ -288,44 +252,26 @@ class SystemStatus(BaseModel):
     - Es mejor mostrar estado parcial que nada
     - Los monitores externos necesitan respuestas consistentes
     """
+    model_config = _OUTPUT_MODEL_CONFIG
+    
     database: bool
     email_service: bool
     openai: bool
     overall: bool
 
-# Utilidades para validación de datos
-class DataValidators:
-    """
-    Utilidades de validación reutilizables.
-    
-    Las separé en una clase porque:
-    - Se usan en múltiples modelos
-    - Facilitan testing unitario
-    - Centralizan la lógica de validación
-    """
-    
-    @staticmethod
-    def validate_email(email: str) -> str:
-        """Validar formato de email reutilizable."""
-        if not email or '@' not in email:
-            raise ValueError('Email inválido')
-        
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email.strip()):
-            raise ValueError('Formato de email inválido')
-            
-        return email.strip().lower()
-    
-    @staticmethod
-    def validate_not_empty(value: str, field_name: str) -> str:
-        """Validar que un string no esté vacío."""
-        if not value or not value.strip():
-            raise ValueError(f'{field_name} no puede estar vacío')
-        return value.strip()
-    
-    @staticmethod
-    def validate_positive_number(value: int, field_name: str) -> int:
-        """Validar que un número sea positivo."""
-        if value <= 0:
-            raise ValueError(f'{field_name} debe ser un número positivo')
-        return value
\ No newline at end of file
+# Utilidades de validación reutilizables (validate_email está arriba, junto a EmailType).
+# Funciones de módulo (antes estáticos de DataValidators): se usan en múltiples
+# modelos, facilitan testing unitario y centralizan la lógica de validación.
+
+def validate_not_empty(value: str, field_name: str) -> str:
+    """Validar que un string no esté vacío."""
+    cleaned = value.strip() if value else ''
+    if not cleaned:
+        raise ValueError(f'{field_name} no puede estar vacío')
+    return cleaned
+
+def validate_positive_number(value: int, field_name: str) -> int:
+    """Validar que un número sea positivo."""
+    if value <= 0:
+        raise ValueError(f'{field_name} debe ser un número positivo')
+    return value
\ No newline at end of file
@@ -4,21 +4,26 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Pooling del driver ODBC (debe fijarse antes del primer connect): reusar evita otro handshake TLS
+pyodbc.pooling = True
+
+# Cadena de conexión construida una sola vez al importar el módulo
+_CONN_STR = (
+    f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+    f"SERVER={os.getenv('DB_SERVER')};"
+    f"DATABASE={os.getenv('DB_DATABASE')};"
+    f"UID={os.getenv('DB_USERNAME')};"
+    f"PWD={os.getenv('DB_PASSWORD')};"
+    f"Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
+)
+
 def test_azure_connection():
     try:
-        # Cadena de conexión
-        connection_string = (
-            f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-            f"SERVER={os.getenv('DB_SERVER')};"
-            f"DATABASE={os.getenv('DB_DATABASE')};"
-            f"UID={os.getenv('DB_USERNAME')};"
-            f"PWD={os.getenv('DB_PASSWORD')};"
-            f"Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
-        )
-        
         print("🔗 Conectando a Azure SQL Database...")
-        conn = pyodbc.connect(connection_string)
+        conn = pyodbc.connect(_CONN_STR)
         cursor = conn.cursor()
+        # executemany manda todos los parámetros en un solo bloque en lugar de fila por fila
+        cursor.fast_executemany = True
         
         print("✅ Conexión exitosa!")
         
@@ -31,8 +36,11 @@ def test_azure_connection():
         # 2. Crear tablas del sistema de biblioteca
         print("📚 Configurando tablas de biblioteca...")
         
-        # Tabla de libros
+        # Tablas + comprobación de datos de prueba en un solo viaje a Azure.
+        # NOCOUNT evita los mensajes "N rows affected" que se intercalan como result sets.
         cursor.execute("""
+        SET NOCOUNT ON;
+        
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='books' AND xtype='U')
         CREATE TABLE books (
             id INT IDENTITY(1,1) PRIMARY KEY,
@@ -41,11 +49,8 @@ def test_azure_connection():
             isbn NVARCHAR(20),
             created_at DATETIME2 DEFAULT GETDATE(),
             available BIT DEFAULT 1
-        )
-        """)
+        );
         
-        # Tabla de reservas
-        cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='reservations' AND xtype='U')
         CREATE TABLE reservations (
             id INT IDENTITY(1,1) PRIMARY KEY,
@@ -55,32 +60,39 @@ def test_azure_connection():
             renewed_at DATETIME2,
             expires_at DATETIME2,
             active BIT DEFAULT 1
-        )
-        """)
+        );
         
-        conn.commit()
+        SELECT CASE WHEN EXISTS (SELECT 1 FROM books WHERE title = ?) THEN 1 ELSE 0 END;
+        """, ('Cien años de soledad',))
+        already_seeded = cursor.fetchone()[0]
         print("✅ Tablas 'books' y 'reservations' creadas/verificadas")
         
-        # 3. Insertar datos de prueba
-        cursor.execute("""
-        IF NOT EXISTS (SELECT 1 FROM books WHERE title = 'Cien años de soledad')
-        INSERT INTO books (title, author, isbn, available) VALUES 
-        ('Cien años de soledad', 'Gabriel García Márquez', '978-8437604947', 1),
-        ('El principito', 'Antoine de Saint-Exupéry', '978-0156013924', 1),
-        ('1984', 'George Orwell', '978-0451524935', 1),
-        ('Don Quijote de la Mancha', 'Miguel de Cervantes', '978-8424113296', 0),
-        ('Cien años de soledad', 'Gabriel García Márquez', '978-0307474728', 1)
-        """)
+        # 3. Insertar datos de prueba (solo si la tabla aún no los tiene)
+        rows = [
+            ('Cien años de soledad', 'Gabriel García Márquez', '978-8437604947', 1),
+            ('El principito', 'Antoine de Saint-Exupéry', '978-0156013924', 1),
+            ('1984', 'George Orwell', '978-0451524935', 1),
+            ('Don Quijote de la Mancha', 'Miguel de Cervantes', '978-8424113296', 0),
+            ('Cien años de soledad', 'Gabriel García Márquez', '978-0307474728', 1),
+        ]
+        if not already_seeded:
+            cursor.executemany(
+                "INSERT INTO books (title, author, isbn, available) VALUES (?, ?, ?, ?)",
+                rows
+            )
         
         conn.commit()
         
-        # 4. Contar libros insertados
-        cursor.execute("SELECT COUNT(*) FROM books")
+        # 4 y 5. Contar y listar libros en un solo batch: dos result sets
+        cursor.execute("""
+        SET NOCOUNT ON;
+        SELECT COUNT(*) FROM books;
+        SELECT title, author, available FROM books;
+        """)
         book_count = cursor.fetchone()[0]
         print(f"📖 Libros en sistema: {book_count}")
         
-        # 5. Mostrar libros disponibles
-        cursor.execute("SELECT title, author, available FROM books")
+        cursor.nextset()
         books = cursor.fetchall()
         
         print("\n📚 Catálogo de libros:")
@@ -0,0 +1,183 @@
+import os
+
+# app.config valida la configuración al importarse: valores de relleno para los tests
+for _name in ('DB_SERVER', 'DB_DATABASE', 'DB_USERNAME', 'DB_PASSWORD',
+              'IMAP_USERNAME', 'IMAP_PASSWORD', 'OPENAI_API_KEY'):
+    os.environ.setdefault(_name, 'test')
+
+import time
+
+from app.database import MockConnection, classify_sql, db, parameterize_sql
+from app.llm_service import LLMService, _JsonObjectScanner, _extract_json_span, get_llm_service
+
+
+# parameterize_sql: solo los literales en posición de valor pasan a parámetros
+
+def test_parameterize_comparisons_and_like():
+    statement, params = parameterize_sql(
+        "SELECT * FROM books WHERE title = 'O''Brien' AND author LIKE N'%García%'"
+    )
+    assert statement == "SELECT * FROM books WHERE title = ? AND author LIKE ?"
+    assert params == ("O'Brien", "%García%")
+
+def test_parameterize_in_list_and_values():
+    assert parameterize_sql("SELECT * FROM books WHERE title IN ('a', 'b')") == (
+        "SELECT * FROM books WHERE title IN (?, ?)", ('a', 'b')
+    )
+    assert parameterize_sql(
+        "INSERT INTO reservations (book_id, user_email) VALUES (1, 'a@b.co')"
+    ) == ("INSERT INTO reservations (book_id, user_email) VALUES (1, ?)", ('a@b.co',))
+
+def test_parameterize_does_not_split_on_isbn_column():
+    # la n final de "isbn" no es el prefijo N'' de NVARCHAR
+    assert parameterize_sql("SELECT * FROM books WHERE isbn='123'") == (
+        "SELECT * FROM books WHERE isbn=?", ('123',)
+    )
+
+def test_parameterize_keeps_separators_inside_literals():
+    assert parameterize_sql("UPDATE books SET title = 'x;--y' WHERE id = 1") == (
+        "UPDATE books SET title = ? WHERE id = 1", ('x;--y',)
+    )
+
+def test_parameterize_leaves_alias_literals():
+    for sql in ("SELECT COUNT(*) AS 'total' FROM books",
+                "SELECT COUNT(*) 'total' FROM books",
+                "SELECT 'total' = COUNT(*) FROM books"):
+        assert parameterize_sql(sql) == (sql, ())
+
+def test_parameterize_leaves_exec_untouched():
+    sql = "EXEC('DROP TABLE books')"
+    assert parameterize_sql(sql) == (sql, ())
+
+def test_parameterize_without_literals():
+    sql = "SELECT TOP 10 * FROM books WHERE available = 1"
+    assert parameterize_sql(sql) == (sql, ())
+
+
+# classify_sql: exactamente una sentencia SELECT/INSERT/UPDATE/DELETE
+
+def test_classify_allows_single_dml_statements():
+    cases = {
+        "SELECT * FROM books WHERE title = 'DROP TABLE x; --'": 'SELECT',
+        "SELECT COUNT(*) AS 'total' FROM books;": 'SELECT',
+        "SELECT * FROM books WHERE id IN (SELECT book_id FROM reservations WHERE active = 1)": 'SELECT',
+        "SELECT title FROM books UNION SELECT user_email FROM reservations": 'SELECT',
+        "INSERT INTO reservations (book_id, user_email) VALUES (1, 'a@b.co')": 'INSERT',
+        "INSERT INTO reservations (book_id, user_email) SELECT id, 'a@b.co' FROM books": 'INSERT',
+        "UPDATE reservations SET expires_at = DATEADD(day, 14, GETDATE()) WHERE id = 1": 'UPDATE',
+        "DELETE FROM reservations WHERE id = 3": 'DELETE',
+    }
+    for sql, expected in cases.items():
+        assert classify_sql(sql) == expected, sql
+
+def test_classify_rejects_stacked_statements_without_semicolon():
+    for sql in ("SELECT * FROM books DROP TABLE reservations",
+                "UPDATE books SET available = 0 EXEC('DROP TABLE books')",
+                "SELECT * FROM books SELECT * FROM reservations",
+                "DELETE FROM reservations WHERE id = 1 SELECT 1",
+                "UPDATE books SET available = 0 WHERE id = 1 UPDATE books SET available = 1",
+                "UPDATE books SET available = 0 SET IDENTITY_INSERT books ON",
+                "INSERT INTO reservations VALUES (1, 'a') SELECT 1",
+                "SELECT * FROM books WAITFOR DELAY '00:00:10'"):
+        assert classify_sql(sql) is None, sql
+
+def test_classify_rejects_select_into_and_output_into():
+    assert classify_sql("SELECT * INTO new_table FROM books") is None
+    assert classify_sql("DELETE FROM reservations OUTPUT deleted.* INTO archive") is None
+
+def test_classify_rejects_separators_comments_and_malformed_sql():
+    for sql in ("SELECT * FROM books; DROP TABLE books",
+                "SELECT * FROM books -- x",
+                "SELECT * FROM books /* x */",
+                "SELECT * FROM books WHERE title = 'x",
+                "SELECT * FROM books)",
+                "DROP TABLE books",
+                "TRUNCATE TABLE reservations",
+                ""):
+        assert classify_sql(sql) is None, sql
+
+
+# Parseo de la respuesta del LLM: JSON puro, en bloque ``` o rodeado de texto
+
+_SQL_JSON = '{"sql": "SELECT 1", "operation_type": "LIST_BOOKS", "explanation": "usa {llaves}"}'
+
+def test_extract_json_span_ignores_braces_inside_strings():
+    assert _extract_json_span('Aquí va: ' + _SQL_JSON + ' ¿algo más? }') == _SQL_JSON
+    assert _extract_json_span('```json\n' + _SQL_JSON + '\n```') == _SQL_JSON
+
+def test_extract_json_span_without_complete_object():
+    assert _extract_json_span('sin json') is None
+    assert _extract_json_span('{"sql": "SELECT 1"') is None
+
+def test_json_scanner_detects_end_across_chunks():
+    scanner = _JsonObjectScanner()
+    chunks = ['```json\n{"sql": "SELECT', ' \\"}\\"", "explanation": "{"', '}\n```']
+    assert [scanner.feed(chunk) for chunk in chunks] == [False, False, True]
+
+def test_parse_sql_response_fallbacks():
+    service = get_llm_service()
+    expected = {"sql": "SELECT 1", "operation_type": "LIST_BOOKS", "explanation": "usa {llaves}"}
+    assert service._parse_sql_response(_SQL_JSON) == expected
+    assert service._parse_sql_response('```json\n' + _SQL_JSON + '\n```') == expected
+    # la última '}' es del texto: el recorte falla y entra el escaneo de llaves
+    assert service._parse_sql_response('Respuesta: ' + _SQL_JSON + ' fin }') == expected
+    fallback = service._parse_sql_response('no entendí')
+    assert fallback["sql"] == LLMService._FALLBACK_SQL
+    assert fallback["operation_type"] == "LIST_BOOKS"
+
+
+# trim_request: sin citas, firma ni espacios sobrantes
+
+def test_trim_request_drops_quotes_and_signature():
+    body = "Quiero reservar 1984\n\n> mensaje citado\n-- \nAna\nBiblioteca"
+    assert LLMService.trim_request(body, 2000) == "Quiero reservar 1984"
+
+def test_trim_request_cuts_at_reply_header_and_limits_length():
+    body = "Renovar   mi reserva\nEl lun, 1 ene 2024, Ana <a@b.co> escribió:\n> hola"
+    assert LLMService.trim_request(body, 2000) == "Renovar mi reserva"
+    assert LLMService.trim_request("a " * 50, 10) == "a a a a a "
+
+def test_trim_request_keeps_body_when_everything_is_quoted():
+    assert LLMService.trim_request("> solo una cita", 2000) == "> solo una cita"
+
+
+# Caché de SQL: LRU acotada y con TTL
+
+_LIST_RESULT = {"sql": "SELECT * FROM books", "operation_type": "LIST_BOOKS", "explanation": "listar"}
+
+def test_sql_cache_only_stores_cacheable_results():
+    service = LLMService()
+    service._cache_put(b"reserva", dict(_LIST_RESULT, operation_type="RESERVE_BOOK"))
+    service._cache_put(b"respaldo", dict(_LIST_RESULT, sql=LLMService._FALLBACK_SQL))
+    assert service._cache_get(b"reserva") is None
+    assert service._cache_get(b"respaldo") is None
+    service._cache_put(b"lista", _LIST_RESULT)
+    assert service._cache_get(b"lista") == _LIST_RESULT
+
+def test_sql_cache_evicts_least_recently_used():
+    service = LLMService()
+    service._SQL_CACHE_MAXSIZE = 2
+    service._cache_put(b"a", _LIST_RESULT)
+    service._cache_put(b"b", _LIST_RESULT)
+    service._cache_get(b"a")  # "a" pasa a ser la más reciente
+    service._cache_put(b"c", _LIST_RESULT)
+    assert service._cache_get(b"b") is None
+    assert service._cache_get(b"a") == _LIST_RESULT
+    assert service._cache_get(b"c") == _LIST_RESULT
+
+def test_sql_cache_entries_expire(monkeypatch):
+    service = LLMService()
+    service._cache_put(b"a", _LIST_RESULT)
+    later = time.monotonic() + LLMService._SQL_CACHE_TTL + 1
+    monkeypatch.setattr(time, "monotonic", lambda: later)
+    assert service._cache_get(b"a") is None
+    assert b"a" not in service._sql_cache
+
+
+# claim_message: un Message-ID se procesa una sola vez
+
+def test_claim_message_rejects_duplicates(monkeypatch):
+    monkeypatch.setattr(db, "get_connection", MockConnection)
+    assert db.claim_message("<dup-test@x>") is True
+    assert db.claim_message("<dup-test@x>") is False
+    assert db.claim_messages(["<dup-test@x>", "<new-test@x>", "<new-test@x>"]) == {"<new-test@x>"}
\ No newline at end of file